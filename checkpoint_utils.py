@@ -0,0 +1,94 @@
+#
+# Copyright (c) 2019 Nutanix Inc. All rights reserved.
+#
+# This module contains the journal of completed configuration stages, which
+# lets a failed run be retried without redoing the stages that succeeded.
+#
+import hashlib
+import json
+import os
+import threading
+
+import crash_utils
+import netUtil
+
+from log import DEBUG, INFO, WARNING
+
+# Written by log.FATAL.
+FATAL_MARKER_PATH = "/tmp/fatal_marker"
+
+def config_hash(cfg):
+  """
+  Returns a digest identifying the configuration json cfg.
+  """
+  return hashlib.sha1(json.dumps(cfg, sort_keys=True).encode("utf-8")
+                      ).hexdigest()
+
+class Journal(object):
+  """
+  Persistent set of the stages completed for one configuration.
+
+  The journal is stored as json in path and rewritten atomically every time
+  a stage completes, so it survives the process exiting through FATAL. A
+  journal left by a run with a different configuration is ignored.
+  """
+  def __init__(self, path, cfg_hash):
+    self.path = path
+    self.cfg_hash = cfg_hash
+    self._lock = threading.Lock()
+    self._done = []
+    self._load()
+
+  def _load(self):
+    try:
+      with open(self.path) as fp:
+        data = json.load(fp)
+    except (IOError, OSError, ValueError):
+      return
+    if data.get("config_hash") != self.cfg_hash:
+      INFO("Ignoring journal %s of a different configuration" % self.path)
+      return
+    self._done = list(data.get("done", []))
+    if self._done:
+      INFO("Resuming, stages completed by an earlier run: %s"
+           % ", ".join(self._done))
+
+  def _save(self):
+    netUtil.write_file_atomic(self.path, json.dumps(
+        {"config_hash": self.cfg_hash, "done": self._done}, indent=2))
+
+  def is_done(self, stage):
+    with self._lock:
+      return stage in self._done
+
+  def mark_done(self, stage):
+    with self._lock:
+      if stage in self._done:
+        return
+      self._done.append(stage)
+      try:
+        self._save()
+      except (IOError, OSError) as e:
+        WARNING("Failed to update journal %s: %s" % (self.path, e))
+
+  def clear(self):
+    """
+    Removes the journal, along with the marker left by a FATAL run.
+    """
+    with self._lock:
+      self._done = []
+      for path in (self.path, FATAL_MARKER_PATH):
+        try:
+          os.unlink(path)
+        except OSError as e:
+          DEBUG("Failed to remove %s: %s" % (path, e))
+
+def get_journal(name, cfg):
+  """
+  Returns the Journal of cfg for the script name, kept in the crashcart
+  directory.
+  """
+  if os.path.exists(FATAL_MARKER_PATH):
+    INFO("An earlier run failed, looking for stages it completed")
+  return Journal(os.path.join(crash_utils.CRASHCART_DIR,
+                              "%s.journal" % name), config_hash(cfg))
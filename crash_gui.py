@@ -601,7 +601,9 @@ class RdmaConfigGui(Gui):
     self.window.addnstr(y, x, msg, 44)
 
     selected_nics = self.get_selected_rdma_nics()
-    passthru_nics = crash_utils.fix_passthru_nics(selected_nics)
+    passthru_nics = crash_utils.fix_passthru_nics(
+        selected_nics, inventory=self.rdma_nics_info,
+        rdma_capable_nics=self.rdma_capable_bus_addrs)
 
     y,x = self.show_rdma_details(self.window, self.handler,
                                  y, x, max_y, passthru_nics)
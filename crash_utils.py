@@ -13,11 +13,15 @@ import netUtil
 
 from log import ERROR, FATAL
 
-HW_CONFIG_PATH = "/root/nutanix-network-crashcart/hardware_config.json"
+CRASHCART_DIR = "/root/nutanix-network-crashcart"
 
-SVM_SSH_KEY_PATH = "/root/nutanix-network-crashcart/nutanix"
+HW_CONFIG_PATH = os.path.join(CRASHCART_DIR, "hardware_config.json")
+
+SVM_SSH_KEY_PATH = os.path.join(CRASHCART_DIR, "nutanix")
 SSH_PATH = "/usr/bin/ssh"
 SCP_PATH = "/usr/bin/scp"
+# Exit status of the scripts when they refuse to run on a node in a cluster.
+IN_CLUSTER_EXIT_CODE = 3
 
 def check_if_in_cluster(fatal=False):
   """
@@ -148,21 +152,30 @@ def get_ethernet_devices_details(bus_addr_list=None):
 
   return output
 
-def fix_passthru_nics(rdma_netdevs):
+def fix_passthru_nics(rdma_netdevs, inventory=None, rdma_capable_nics=None):
   """
   Since only nic_passthru is supported,
   returns all nics to be passed through to pass through rdma_netdevs
   Args:
     rdma_netdevs (list): List of intf names selected
+    inventory (dict): NicInfo keyed by intf name, as returned by
+        get_ethernet_devices_details. Nics missing from it are probed.
+    rdma_capable_nics (list): Bus addresses of rdma capable nics, read from
+        hardware_config.json if None.
   """
   out = set(rdma_netdevs)
-  rdma_capable_nics = get_rdma_nics()
+  inventory = inventory or {}
+  if rdma_capable_nics is None:
+    rdma_capable_nics = get_rdma_nics()
+  netdevs_by_bus_addr = dict((nic_info.bus_addr, dev)
+                             for dev, nic_info in inventory.items())
 
   for netdev in rdma_netdevs:
-    nic_info = NicInfo(netdev)
+    nic_info = inventory.get(netdev) or NicInfo(netdev)
     index = rdma_capable_nics.index(nic_info.bus_addr)
     other_index = index + 1 if index%2 == 0 else index - 1
-    out.add(netUtil.get_netdev_from_bus_addr(
-      rdma_capable_nics[other_index]))
+    other_bus_addr = rdma_capable_nics[other_index]
+    out.add(netdevs_by_bus_addr.get(other_bus_addr) or
+            netUtil.get_netdev_from_bus_addr(other_bus_addr))
 
   return list(out)
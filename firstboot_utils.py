@@ -11,9 +11,10 @@ import os
 import re
 import shutil
 import subprocess
-import time
 import threading
 
+import trace_utils
+
 from log import INFO, FATAL, ERROR
 
 # Constants to represent state of the system.
@@ -22,6 +23,8 @@ ONE_NODE_INSTALL_SUCCESS = "one_node_install_success"
 SVM_SSH_KEY_PATH = None
 SSH_PATH = None
 SCP_PATH = None
+# Extra ssh options set by enable_ssh_connection_sharing.
+SSH_CONTROL_ARGS = []
 
 def initialize_ssh_keys(svm_ssh_key_path, ssh_path, scp_path):
   global SVM_SSH_KEY_PATH
@@ -32,6 +35,20 @@ def initialize_ssh_keys(svm_ssh_key_path, ssh_path, scp_path):
   SCP_PATH = scp_path
 
 
+def enable_ssh_connection_sharing(control_dir, persist_secs=600):
+  """
+  Makes ssh calls to a host share one master connection, which is kept open
+  persist_secs seconds after the last call. Later calls skip the connection
+  and authentication setup.
+  """
+  global SSH_CONTROL_ARGS
+  if not os.path.isdir(control_dir):
+    os.makedirs(control_dir, 0o700)
+  SSH_CONTROL_ARGS = ["-o", "ControlMaster=auto",
+                      "-o", "ControlPath=%s/%%r@%%h:%%p" % control_dir,
+                      "-o", "ControlPersist=%d" % persist_secs]
+
+
 def run_cmd(cmd_array, retry=False, fatal=True, timeout=None, quiet=False):
   """
   Runs a system command specified in the cmd_params array. The function
@@ -51,7 +68,7 @@ def run_cmd(cmd_array, retry=False, fatal=True, timeout=None, quiet=False):
 
 
 def run_cmd_new(cmd_array, attempts=1, retry_wait=5, fatal=True, timeout=None,
-                quiet=False):
+                quiet=False, input_data=None):
   """
   Runs a system command specified in the cmd_params array.
 
@@ -62,6 +79,7 @@ def run_cmd_new(cmd_array, attempts=1, retry_wait=5, fatal=True, timeout=None,
     fatal: Method exists with FATAL if True.
     timeout: time in seconds to wait for a command to complete.
     quiet: If True doesn't print INFO messages.
+    input_data: Bytes written to the stdin of the command.
 
   NOTE:
     Since, we are running our subprocess with shell=True timeout will
@@ -83,7 +101,9 @@ def run_cmd_new(cmd_array, attempts=1, retry_wait=5, fatal=True, timeout=None,
   return_code = 0
 
   for _ in range(attempts):
-    process = subprocess.Popen(cmd_array, shell=True, stdout=subprocess.PIPE,
+    stdin = subprocess.PIPE if input_data is not None else None
+    process = subprocess.Popen(cmd_array, shell=True, stdin=stdin,
+                               stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
     process.timed_out = False
 
@@ -102,7 +122,9 @@ def run_cmd_new(cmd_array, attempts=1, retry_wait=5, fatal=True, timeout=None,
 
     timer = threading.Timer(timeout, kill_process)
     timer.start()
-    stdout, stderr = process.communicate()
+    with trace_utils.span(cmd_array[0][:80], trace_utils.CMD,
+                          {"cmd": cmd_array[0]}):
+      stdout, stderr = process.communicate(input_data)
     stdout = stdout.decode('utf-8', 'ignore')
     stderr = stderr.decode('utf-8', 'ignore')
     return_code = process.returncode
@@ -119,7 +141,7 @@ def run_cmd_new(cmd_array, attempts=1, retry_wait=5, fatal=True, timeout=None,
         if not quiet:
           INFO("Execution of command %s failed, exit code: %s, stdout: %s, "
                 "stderr: %s" % (cmd_array, return_code, stdout, stderr))
-      time.sleep(retry_wait)
+      trace_utils.sleep(retry_wait, "retry_wait")
   else:
     if fatal:
       FATAL("Execution of command %s failed, exit code: %s, stdout: %s, "
@@ -129,7 +151,8 @@ def run_cmd_new(cmd_array, attempts=1, retry_wait=5, fatal=True, timeout=None,
 
 
 def run_cmd_on_svm(cmd=None, dest_host="nutanix@192.168.5.2", attempts=5,
-                   retry_wait=5, fatal=True, timeout=None, quiet=False):
+                   retry_wait=5, fatal=True, timeout=None, quiet=False,
+                   input_data=None):
   """
   This function will run a command on the SVM
   """
@@ -138,12 +161,13 @@ def run_cmd_on_svm(cmd=None, dest_host="nutanix@192.168.5.2", attempts=5,
   ssh_key_path = SVM_SSH_KEY_PATH
   return run_cmd_on_server(
     cmd=cmd, dest_host=dest_host, ssh_key_path=ssh_key_path, fatal=fatal,
-    attempts=attempts, retry_wait=retry_wait, timeout=timeout, quiet=quiet)
+    attempts=attempts, retry_wait=retry_wait, timeout=timeout, quiet=quiet,
+    input_data=input_data)
 
 
 def run_cmd_on_server(cmd, dest_host, ssh_key_path=None,
                       attempts=1, retry_wait=5, fatal=True, timeout=None,
-                      quiet=False):
+                      quiet=False, input_data=None):
   """
   This function will run a command on the specified server
   """
@@ -153,13 +177,40 @@ def run_cmd_on_server(cmd, dest_host, ssh_key_path=None,
   common_args = ["-i", ssh_key_path,
                  "-o", "StrictHostKeyChecking=no",
                  "-o", "NumberOfPasswordPrompts=0",
-                 "-o", "UserKnownHostsFile=/dev/null"]
+                 "-o", "UserKnownHostsFile=/dev/null"] + SSH_CONTROL_ARGS
 
   # SSH
   cmd_array = [SSH_PATH] + common_args + [dest_host, '"%s"' % cmd]
-  return run_cmd_new(cmd_array=cmd_array, attempts=attempts,
-                     retry_wait=retry_wait, fatal=fatal, timeout=timeout,
-                     quiet=quiet)
+  with trace_utils.span("ssh %s" % dest_host, trace_utils.SSH, {"cmd": cmd}):
+    return run_cmd_new(cmd_array=cmd_array, attempts=attempts,
+                       retry_wait=retry_wait, fatal=fatal, timeout=timeout,
+                       quiet=quiet, input_data=input_data)
+
+
+def put_bytes(content, dest_path, dest_host="nutanix@192.168.5.2",
+              owner=None, mode="644", ssh_key_path=None, attempts=5,
+              fatal=True):
+  """
+  This function will install content as dest_path on the specified server.
+
+  The content is streamed from memory over the stdin of a single ssh call,
+  written to a temporary file next to dest_path, given mode and, if set,
+  owner, and renamed over dest_path, so the file is replaced atomically.
+  Without owner the file is owned by root, as it is written through sudo.
+
+  Returns:
+    (stdout, stderr, return_code), exits with FATAL if fatal=True
+  """
+  if not isinstance(content, bytes):
+    content = content.encode("utf-8")
+  temp_path = "%s.crashcart.tmp" % dest_path
+  chown = "chown %s %s && " % (owner, temp_path) if owner else ""
+  cmd = ("sudo sh -c 'cat > %(temp)s && %(chown)schmod %(mode)s %(temp)s && "
+         "mv -f %(temp)s %(dest)s'" %
+         {"temp": temp_path, "chown": chown, "mode": mode, "dest": dest_path})
+  INFO("Installing %s on %s" % (dest_path, dest_host))
+  return run_cmd_on_server(cmd, dest_host, ssh_key_path=ssh_key_path,
+                           attempts=attempts, fatal=fatal, input_data=content)
 
 
 def scp_files_to_svm(src_path, dest_path, dest_host="nutanix@192.168.5.2",
@@ -308,6 +359,6 @@ def copy_cvm_logs_to_hypervisor(copy_to):
       INFO("Failed to read log file %s on CVM." % log)
 
 __all__ = ["initialize_ssh_keys", "run_cmd", "run_cmd_new", "run_cmd_on_svm",
-           "scp_files_to_svm", "get_pci_bus_addresses",
+           "scp_files_to_svm", "put_bytes", "get_pci_bus_addresses",
            "ONE_NODE_INSTALL_SUCCESS", "configure_ptagent",
-           "copy_cvm_logs_to_hypervisor"]
+           "copy_cvm_logs_to_hypervisor", "enable_ssh_connection_sharing"]
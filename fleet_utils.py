@@ -0,0 +1,346 @@
+#
+# Copyright (c) 2019 Nutanix Inc. All rights reserved.
+#
+# This module contains functions for running network_configuration on many
+# nodes concurrently from a single manifest.
+#
+# The manifest is a json file of the form:
+#   {
+#     "max_workers": 4,
+#     "ssh_key_path": "/root/.ssh/id_rsa",
+#     "nodes": [
+#       {"host": "10.1.1.11", "config": {...}},
+#       {"host": "10.1.1.12", "config_file": "node12.json"}
+#     ]
+#   }
+# where config is the input of network_configuration and config_file is
+# relative to the manifest.
+#
+# network_configuration is started detached on the node, as it may re-IP the
+# address the driver connects to, which kills the ssh session. The driver
+# then polls for its exit status, on the node address and on the static
+# addresses the config gives to the host.
+#
+import json
+import os
+import threading
+import time
+
+import crash_utils
+import firstboot_utils
+import netUtil
+
+from log import ERROR, INFO
+
+FLEET_CONFIG_NAME = "fleet_config.json"
+FLEET_RUNNER_NAME = "fleet_run.sh"
+FLEET_LOG_NAME = "fleet_run.log"
+FLEET_STATUS_NAME = "fleet_run.rc"
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_TIMEOUT_SECS = 1800
+DEFAULT_POLL_INTERVAL_SECS = 10
+# Seconds allowed for a single command on a node, e.g. reading the status.
+COMMAND_TIMEOUT_SECS = 30
+
+# Runs network_configuration in the directory of the script and records its
+# exit status, which is written last and atomically.
+FLEET_RUNNER = """#!/bin/sh
+cd "$(dirname "$0")" || exit 1
+./network_configuration %(config)s > %(log)s 2>&1
+echo $? > %(status)s.tmp && mv -f %(status)s.tmp %(status)s
+""" % {"config": FLEET_CONFIG_NAME, "log": FLEET_LOG_NAME,
+       "status": FLEET_STATUS_NAME}
+
+# Node states.
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+INVALID = "invalid"
+SKIPPED = "skipped"
+
+class SshTransport(object):
+  """
+  Reaches the nodes as root over ssh. Crashcart is expected to be installed
+  in crash_utils.CRASHCART_DIR on every node.
+  """
+  def __init__(self, ssh_key_path=None, user="root"):
+    self.ssh_key_path = ssh_key_path
+    self.user = user
+
+  def _dest(self, host):
+    return "%s@%s" % (self.user, host)
+
+  def crashcart_dir(self, host):
+    return crash_utils.CRASHCART_DIR
+
+  def put(self, host, content, dest_path):
+    """
+    Installs content as dest_path on host.
+    Returns True if successful, False otherwise.
+    """
+    _, stderr, return_code = firstboot_utils.put_bytes(
+        content, dest_path, dest_host=self._dest(host), mode="600",
+        ssh_key_path=self.ssh_key_path, attempts=3, fatal=False)
+    if return_code:
+      ERROR("Failed to copy %s to %s: %s" % (dest_path, host, stderr))
+    return not return_code
+
+  def run(self, host, cmd, timeout=None):
+    """
+    Runs cmd on host.
+    Returns (stdout, stderr, return_code).
+    """
+    return firstboot_utils.run_cmd_on_server(
+        cmd, self._dest(host), ssh_key_path=self.ssh_key_path, retry_wait=0,
+        fatal=False, timeout=timeout, quiet=True)
+
+class LocalTransport(object):
+  """
+  Stand-in for SshTransport which runs everything on the local machine.
+  Every node is a directory named after the host under root_dir, which takes
+  the place of the crashcart directory of the node. Used to exercise the fleet
+  driver without real nodes, e.g. with a stub network_configuration.
+  """
+  def __init__(self, root_dir):
+    self.root_dir = os.path.abspath(root_dir)
+
+  def crashcart_dir(self, host):
+    return os.path.join(self.root_dir, host)
+
+  def put(self, host, content, dest_path):
+    try:
+      netUtil.write_file_atomic(dest_path, content, mode=0o600)
+    except (IOError, OSError) as e:
+      ERROR("Failed to write %s: %s" % (dest_path, e))
+      return False
+    return True
+
+  def run(self, host, cmd, timeout=None):
+    return firstboot_utils.run_cmd_new([cmd], retry_wait=0, fatal=False,
+                                       timeout=timeout, quiet=True)
+
+def load_manifest(path):
+  """
+  Reads the manifest at path, see the module docstring.
+
+  Returns:
+    Tuple (nodes, options) where nodes is a list of dicts with keys host and
+    config, and options is a dict with the remaining manifest keys.
+    Raises ValueError if the manifest is malformed.
+  """
+  with open(path) as fp:
+    manifest = json.load(fp)
+  base_dir = os.path.dirname(os.path.abspath(path))
+
+  nodes = []
+  hosts = set()
+  for entry in manifest.get("nodes", []):
+    host = entry.get("host")
+    if not host:
+      raise ValueError("Node entry %s has no host" % entry)
+    if host in hosts:
+      raise ValueError("Host %s is listed more than once" % host)
+    hosts.add(host)
+    if "config" in entry:
+      config = entry["config"]
+    elif "config_file" in entry:
+      with open(os.path.join(base_dir, entry["config_file"])) as fp:
+        config = json.load(fp)
+    else:
+      raise ValueError("Node %s has neither config nor config_file" % host)
+    nodes.append({"host": host, "config": config})
+  if not nodes:
+    raise ValueError("Manifest %s lists no nodes" % path)
+
+  options = dict((key, value) for key, value in manifest.items()
+                 if key != "nodes")
+  return nodes, options
+
+def get_poll_hosts(node):
+  """
+  Returns the addresses the node may be reached on once configured: its
+  current address, then the static addresses its config gives to the host.
+  """
+  hosts = [node["host"]]
+  for iface in node["config"].get("host_interfaces", []):
+    ip = iface.get("ip")
+    if (iface.get("vswitch") != "_internal_" and ip and ip != "dhcp" and
+        ip not in hosts):
+      hosts.append(ip)
+  return hosts
+
+def start_run(transport, host, node_dir):
+  """
+  Starts network_configuration detached from the session on host.
+  Returns True if it was started.
+  """
+  if not transport.put(host, FLEET_RUNNER,
+                       os.path.join(node_dir, FLEET_RUNNER_NAME)):
+    return False
+  cmd = ("cd %s && rm -f %s && setsid nohup sh %s < /dev/null > /dev/null "
+         "2>&1 &" % (node_dir, FLEET_STATUS_NAME, FLEET_RUNNER_NAME))
+  _, stderr, return_code = transport.run(host, cmd,
+                                         timeout=COMMAND_TIMEOUT_SECS)
+  if return_code:
+    ERROR("Failed to start network_configuration on %s: %s" % (host, stderr))
+  return not return_code
+
+def wait_for_run(transport, node, node_dir, timeout, poll_interval):
+  """
+  Polls the addresses of get_poll_hosts for the exit status of the run.
+
+  Returns:
+    Tuple (return_code, output) of network_configuration, return_code is
+    None if no status showed up within timeout seconds.
+  """
+  deadline = time.time() + timeout
+  status_path = os.path.join(node_dir, FLEET_STATUS_NAME)
+  log_path = os.path.join(node_dir, FLEET_LOG_NAME)
+  while True:
+    for host in get_poll_hosts(node):
+      stdout, _, return_code = transport.run(host, "cat %s" % status_path,
+                                             timeout=COMMAND_TIMEOUT_SECS)
+      if return_code or not stdout.strip().isdigit():
+        continue
+      output, _, _ = transport.run(host, "cat %s" % log_path,
+                                   timeout=COMMAND_TIMEOUT_SECS)
+      if host != node["host"]:
+        INFO("%s is now reachable on %s" % (node["host"], host))
+      return int(stdout.strip()), output
+    if time.time() >= deadline:
+      return None, ""
+    time.sleep(poll_interval)
+
+def configure_node(transport, node, log_dir, timeout=DEFAULT_TIMEOUT_SECS,
+                   poll_interval=DEFAULT_POLL_INTERVAL_SECS):
+  """
+  Pushes the config of node, starts network_configuration on it and waits
+  for it to exit. The output of the run is saved in log_dir/<host>.log.
+
+  Returns:
+    Result dict with keys host, state, duration and error.
+  """
+  host = node["host"]
+  start = time.time()
+  result = {"host": host, "state": FAILED, "duration": 0, "error": ""}
+  node_dir = transport.crashcart_dir(host)
+  config_path = os.path.join(node_dir, FLEET_CONFIG_NAME)
+  INFO("Configuring %s" % host)
+
+  if not transport.put(host, json.dumps(node["config"], indent=2),
+                       config_path):
+    result["error"] = "failed to copy config"
+  elif not start_run(transport, host, node_dir):
+    result["error"] = "failed to start network_configuration"
+  else:
+    return_code, output = wait_for_run(transport, node, node_dir, timeout,
+                                       poll_interval)
+    log_path = os.path.join(log_dir, "%s.log" % host)
+    try:
+      with open(log_path, "w") as fp:
+        fp.write(output)
+    except (IOError, OSError) as e:
+      ERROR("Failed to write %s: %s" % (log_path, e))
+    if return_code is None:
+      result["error"] = "no exit status after %s seconds" % timeout
+    elif return_code == crash_utils.IN_CLUSTER_EXIT_CODE:
+      result["state"] = SKIPPED
+      result["error"] = "node is in a cluster"
+    elif return_code:
+      lines = output.strip().splitlines()
+      result["error"] = "exit code %s%s" % (
+          return_code, ": %s" % lines[-1] if lines else "")
+    else:
+      result["state"] = SUCCEEDED
+
+  result["duration"] = time.time() - start
+  if result["state"] == SUCCEEDED:
+    INFO("Configured %s in %.0f seconds" % (host, result["duration"]))
+  elif result["state"] == SKIPPED:
+    ERROR("Skipped %s: %s" % (host, result["error"]))
+  else:
+    ERROR("Failed to configure %s: %s" % (host, result["error"]))
+  return result
+
+def run_fleet(nodes, transport, log_dir, validate=None,
+              max_workers=DEFAULT_MAX_WORKERS, timeout=DEFAULT_TIMEOUT_SECS,
+              poll_interval=DEFAULT_POLL_INTERVAL_SECS):
+  """
+  Configures nodes with at most max_workers nodes in flight. A failed node
+  does not stop the others.
+
+  Args:
+    nodes: Nodes as returned by load_manifest.
+    transport: SshTransport or LocalTransport.
+    log_dir: Directory receiving the per-node logs.
+    validate: Callable taking a node config and returning True if it is
+        valid. Invalid nodes are reported and not touched.
+    max_workers: Maximum number of nodes configured at the same time.
+    timeout: Seconds allowed for network_configuration on a node.
+    poll_interval: Seconds between polls for the end of a run.
+
+  Returns:
+    List of result dicts, see configure_node, in the order of nodes.
+  """
+  if not os.path.isdir(log_dir):
+    os.makedirs(log_dir)
+
+  results = {}
+  pending = []
+  for node in nodes:
+    try:
+      valid = not validate or validate(node["config"])
+    except SystemExit:
+      # Malformed configs make validate_parameters FATAL.
+      valid = False
+    if not valid:
+      ERROR("Config of %s is invalid, skipping it" % node["host"])
+      results[node["host"]] = {"host": node["host"], "state": INVALID,
+                               "duration": 0,
+                               "error": "invalid config"}
+    else:
+      pending.append(node)
+
+  lock = threading.Lock()
+  def worker():
+    while True:
+      with lock:
+        if not pending:
+          return
+        node = pending.pop(0)
+      try:
+        result = configure_node(transport, node, log_dir, timeout=timeout,
+                                poll_interval=poll_interval)
+      except BaseException as e:
+        # FATAL exits through SystemExit, which must not escape the thread.
+        result = {"host": node["host"], "state": FAILED, "duration": 0,
+                  "error": str(e)}
+      with lock:
+        results[node["host"]] = result
+
+  threads = []
+  for i in range(min(max_workers, len(pending))):
+    thread = threading.Thread(target=worker, name="fleet-%s" % i)
+    thread.daemon = True
+    threads.append(thread)
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  return [results[node["host"]] for node in nodes]
+
+def format_summary(results):
+  """
+  Returns the results of run_fleet as a table.
+  """
+  rows = [("HOST", "STATE", "TIME", "ERROR")]
+  for result in results:
+    rows.append((result["host"], result["state"],
+                 "%.0fs" % result["duration"], result["error"]))
+  widths = [max(len(row[i]) for row in rows) for i in range(3)]
+  lines = []
+  for row in rows:
+    lines.append("  ".join(row[i].ljust(widths[i]) for i in range(3)) +
+                 "  " + row[3])
+  succeeded = len([r for r in results if r["state"] == SUCCEEDED])
+  lines.append("%s of %s nodes configured" % (succeeded, len(results)))
+  return "\n".join(line.rstrip() for line in lines)
@@ -0,0 +1,121 @@
+#
+# Copyright (c) 2019 Nutanix Inc. All rights reserved.
+#
+# Offline tests of fleet_utils. Nodes are LocalTransport directories with a
+# stub network_configuration which exits with the status in its config.
+# SshTransport, and a node changing address while it runs, are not covered.
+#
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import crash_utils
+import fleet_utils
+
+STUB = """#!/bin/sh
+echo "configuring with $1"
+grep -q '"hang"' "$1" && sleep 5
+status=$(sed -n 's/.*"exit": *\\([0-9]*\\).*/\\1/p' "$1")
+[ "$status" = 0 ] || echo "stub failed" >&2
+exit $status
+"""
+
+class FleetUtilsTest(unittest.TestCase):
+  def setUp(self):
+    self.root_dir = tempfile.mkdtemp()
+    self.log_dir = os.path.join(self.root_dir, "logs")
+    os.makedirs(self.log_dir)
+    self.transport = fleet_utils.LocalTransport(
+        os.path.join(self.root_dir, "nodes"))
+
+  def tearDown(self):
+    shutil.rmtree(self.root_dir)
+
+  def make_node(self, host, exit_code):
+    node_dir = self.transport.crashcart_dir(host)
+    os.makedirs(node_dir)
+    path = os.path.join(node_dir, "network_configuration")
+    with open(path, "w") as fp:
+      fp.write(STUB)
+    os.chmod(path, 0o755)
+    return {"host": host, "config": {"exit": exit_code}}
+
+  def test_states(self):
+    nodes = [self.make_node("succeeds", 0),
+             self.make_node("fails", 1),
+             self.make_node("in-cluster", crash_utils.IN_CLUSTER_EXIT_CODE),
+             self.make_node("invalid", 0)]
+    results = fleet_utils.run_fleet(
+        nodes, self.transport, self.log_dir, max_workers=2, poll_interval=0.1,
+        validate=lambda config: nodes[3]["config"] is not config)
+
+    self.assertEqual([result["host"] for result in results],
+                     [node["host"] for node in nodes])
+    self.assertEqual([result["state"] for result in results],
+                     [fleet_utils.SUCCEEDED, fleet_utils.FAILED,
+                      fleet_utils.SKIPPED, fleet_utils.INVALID])
+    self.assertEqual(results[1]["error"], "exit code 1: stub failed")
+    self.assertEqual(results[2]["error"], "node is in a cluster")
+
+    node_dir = self.transport.crashcart_dir("succeeds")
+    with open(os.path.join(node_dir, fleet_utils.FLEET_CONFIG_NAME)) as fp:
+      self.assertEqual(json.load(fp), {"exit": 0})
+    with open(os.path.join(self.log_dir, "succeeds.log")) as fp:
+      self.assertIn("configuring with %s" % fleet_utils.FLEET_CONFIG_NAME,
+                    fp.read())
+    self.assertFalse(os.path.exists(os.path.join(self.log_dir,
+                                                 "invalid.log")))
+
+  def test_timeout(self):
+    node = self.make_node("hangs", 0)
+    node["config"]["hang"] = True
+    start = time.time()
+    result = fleet_utils.configure_node(self.transport, node, self.log_dir,
+                                        timeout=0.5, poll_interval=0.1)
+    self.assertLess(time.time() - start, 5)
+    self.assertEqual(result["state"], fleet_utils.FAILED)
+    self.assertEqual(result["error"], "no exit status after 0.5 seconds")
+
+  def test_poll_hosts(self):
+    node = {"host": "10.0.0.5", "config": {"host_interfaces": [
+        {"name": "br0", "vswitch": "br0", "ip": "10.1.0.5"},
+        {"name": "br1", "vswitch": "br1", "ip": "dhcp"},
+        {"name": "virbr0", "vswitch": "_internal_", "ip": "192.168.5.1"}]}}
+    self.assertEqual(fleet_utils.get_poll_hosts(node),
+                     ["10.0.0.5", "10.1.0.5"])
+
+  def test_validate_fatal_marks_node_invalid(self):
+    def validate(config):
+      raise SystemExit(1)
+    results = fleet_utils.run_fleet([self.make_node("node", 0)],
+                                    self.transport, self.log_dir,
+                                    validate=validate, poll_interval=0.1)
+    self.assertEqual(results[0]["state"], fleet_utils.INVALID)
+
+  def test_load_manifest(self):
+    with open(os.path.join(self.root_dir, "node2.json"), "w") as fp:
+      json.dump({"exit": 1}, fp)
+    path = os.path.join(self.root_dir, "manifest.json")
+    with open(path, "w") as fp:
+      json.dump({"max_workers": 2, "nodes": [
+          {"host": "node1", "config": {"exit": 0}},
+          {"host": "node2", "config_file": "node2.json"}]}, fp)
+    nodes, options = fleet_utils.load_manifest(path)
+    self.assertEqual(nodes, [{"host": "node1", "config": {"exit": 0}},
+                             {"host": "node2", "config": {"exit": 1}}])
+    self.assertEqual(options, {"max_workers": 2})
+
+  def test_summary(self):
+    summary = fleet_utils.format_summary([
+        {"host": "node1", "state": fleet_utils.SUCCEEDED, "duration": 12,
+         "error": ""},
+        {"host": "node2", "state": fleet_utils.SKIPPED, "duration": 1,
+         "error": "node is in a cluster"}])
+    self.assertTrue(summary.endswith("1 of 2 nodes configured"))
+    self.assertIn("node2  skipped", summary)
+
+if __name__ == "__main__":
+  unittest.main()
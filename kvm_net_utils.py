@@ -7,7 +7,11 @@
 #
 import os
 import re
-import time
+
+import libvirt_utils
+import neighbor_utils
+import netUtil
+import trace_utils
 
 from firstboot_utils import (
     run_cmd, run_cmd_new, run_cmd_on_svm)
@@ -49,6 +53,10 @@ VALID_BOND_MODES = ["active-backup", "balance-tcp", "balance-slb"]
 DEFAULT_BOND_MODE = "active-backup"
 DEFAULT_UPLINKS = ["igb", "ixgbe", "i40e", "mlx4_core", "mlx5_core"]
 
+# Supported speeds of each interface, which are a property of the hardware.
+# Kept so that repeated inventories do not run ethtool again.
+_supported_speeds = {}
+
 def get_supported_speeds(intf):
   """
   Find the supported speeds for an interface.
@@ -60,6 +68,8 @@ def get_supported_speeds(intf):
     List of supported speeds in Gbps. If unable to figure out the speed,
     empty list is returned.
   """
+  if intf in _supported_speeds:
+    return list(_supported_speeds[intf])
   speeds = []
   out, _, ret = run_cmd_new(["ethtool", intf], fatal=False)
   if ret:
@@ -73,8 +83,12 @@ def get_supported_speeds(intf):
       speed_list = re.findall(r'\d+', t)
       if speed_list:
         speeds.append(int(speed_list[0]))
+  _supported_speeds[intf] = list(speeds)
   return speeds
 
+def clear_supported_speeds_cache():
+  _supported_speeds.clear()
+
 def get_max_supported_speed(intf):
   """
   Find the maximum supported speed for an interface.
@@ -181,8 +195,19 @@ def is_interface_up(intf):
     return True
   return False
 
-def configure_ovs(cfg, passthru_nics=None, arch="x86_64"):
+def configure_ovs(cfg, passthru_nics=None, arch="x86_64", ifcfg_store=None):
+  """
+  Creates the vswitches and configures the host interfaces on them.
+
+  Args:
+    cfg: Network configuration json.
+    passthru_nics: List of bus addresses of nics which must not be used.
+    arch: Host architecture.
+    ifcfg_store: netUtil.IfcfgStore with changes staged by earlier steps, a
+        new one is loaded if None.
+  """
   passthru_nics = passthru_nics or []
+  ifcfg_store = ifcfg_store or netUtil.IfcfgStore()
   run_cmd(["/sbin/restorecon", "-R", "/etc/sysconfig/network-scripts"])
 
   #### First, create the vswitches ####
@@ -241,10 +266,13 @@ def configure_ovs(cfg, passthru_nics=None, arch="x86_64"):
     INFO("Adding %s to the list of uplinks for vswitch %s"
          % (uplink_devs, name))
 
-    # Set MTU properly for each uplink, then reload each interface
+    # Set MTU properly for each uplink, then reload each changed interface
     for dev in uplink_devs:
-      with open("/etc/sysconfig/network-scripts/ifcfg-" + dev, "a") as ifcfg:
-        ifcfg.write('MTU=%d\n' % vs.get("mtu", 1500))
+      ifcfg_store.set(dev, "MTU", "%d" % vs.get("mtu", 1500))
+    changed_devs = ifcfg_store.commit(uplink_devs)
+    for dev in uplink_devs:
+      if dev not in changed_devs:
+        continue
       if arch == "x86_64" or is_interface_up(dev):
         run_cmd(["/sbin/ifdown", dev], fatal=False)
         run_cmd(["/sbin/ifup", dev], fatal=False)
@@ -308,14 +336,17 @@ def configure_ovs(cfg, passthru_nics=None, arch="x86_64"):
       run_cmd(["ovs-vsctl " + " -- ".join(cmds)])
 
     # Add dependent interfaces to OVSREQUIRES
-    with open("/etc/sysconfig/network-scripts/ifcfg-" + name, "a") as ifcfg:
-      uplinks = vswitch_uplinks[vswitch]
-      if arch == "ppc64le":
-        uplinks = [uplink for uplink in uplinks if is_interface_up(uplink)]
-      ifcfg.write('OVSREQUIRES="%s"\n' % " ".join(uplinks))
+    uplinks = vswitch_uplinks[vswitch]
+    if arch == "ppc64le":
+      uplinks = [uplink for uplink in uplinks if is_interface_up(uplink)]
+    ifcfg_store.set(name, "OVSREQUIRES", '"%s"' % " ".join(uplinks))
+
+  changed = ifcfg_store.commit()
+  if changed:
+    INFO("Updated ifcfg files of %s" % ", ".join(changed))
 
   # Sleep for 5 seconds, then reload all host_interfaces.
-  time.sleep(5)  # For the uplinks to come up.
+  trace_utils.sleep(5, "wait_for_uplinks")  # For the uplinks to come up.
   for iface in host_interfaces:
     run_cmd(["/sbin/ifdown", iface["name"]], fatal=False)
     run_cmd(["/sbin/ifup", iface["name"]], fatal=False)
@@ -323,75 +354,46 @@ def configure_ovs(cfg, passthru_nics=None, arch="x86_64"):
 
   # ENG-57953 Fix arp table for bad switches.
   # This is similar to what livecd.sh does to make things work for phoenix.
+  addresses = []
   for iface in host_interfaces:
     iface_name = iface["name"]
-    interface_config = parse_interface_config(iface_name)
+    interface_config = ifcfg_store.get_config(iface_name)
     if (interface_config and
-        interface_config.get("BOOTPROTO", "").lower() is not "dhcp" and
+        interface_config.get("BOOTPROTO", "").lower() != "dhcp" and
         interface_config.get("IPADDR") and
         interface_config.get("NETMASK")):
-
-      ip = interface_config["IPADDR"]
-
-      # Update switch ARP table.
-      run_cmd(["arping -A -I %s %s -c 1" % (iface_name, ip)], fatal=False)
-      run_cmd(["sleep 2"], fatal=False)
-      run_cmd(["arping -U -I %s %s -c 1" % (iface_name, ip)], fatal=False)
-
-      # Broadcast ping. Seems to help with broken switches.
-      netmask = interface_config["NETMASK"]
-      out = run_cmd(["ipcalc -b %s %s" % (ip, netmask)], fatal=False)
-
-      if out and out.strip():
-        try:
-          # out looks like BROADCASTIP=some_ip.
-          broadcast_ip = out.strip().split("=")[1]
-          run_cmd(["ping -b -c 1 %s -W 1" % broadcast_ip], fatal=False)
-        except IndexError:
-          pass
+      addresses.append((iface_name, interface_config["IPADDR"],
+                        interface_config["NETMASK"]))
+  neighbor_utils.announce_addresses(addresses)
 
 
-def parse_interface_config(interface):
-  interface_config = {}
-
-  interface_config_file = "/etc/sysconfig/network-scripts/ifcfg-%s" % interface
-  if not os.path.exists(interface_config_file):
-    return interface_config
+def parse_interface_config(interface, ifcfg_store=None):
+  """
+  Returns the settings in the ifcfg file of interface as a dict.
 
-  with open(interface_config_file) as fp:
-    config = fp.read()
-    for line in config.strip().splitlines():
-      if line.startswith("#"):
-        continue
-      try:
-        key, value = line.strip().split("=")
-        interface_config[key] = value
-      except ValueError:
-        pass
-  return interface_config
+  Args:
+    interface: Name of the interface.
+    ifcfg_store: netUtil.IfcfgStore to look the interface up in. Only the
+        file of interface is read if None.
+  """
+  if not ifcfg_store:
+    ifcfg_store = netUtil.IfcfgStore(load=False)
+  return ifcfg_store.get_config(interface)
 
 def undefine_libvirt_network(name, destroy=True, fatal=False):
-  out = run_cmd(["virsh", "net-list", "--all"])
-  if name in out:
-    if destroy:
-      run_cmd(["virsh", "net-destroy", name], fatal=fatal)
-    run_cmd(["virsh", "net-undefine", name], fatal=fatal)
+  libvirt_utils.undefine_libvirt_network(libvirt_utils.get_connection(), name,
+                                         destroy=destroy, fatal=fatal)
 
 def create_libvirt_networks():
-  # Delete "default" network installed by libvirt.
-  undefine_libvirt_network("default")
-
-  for net, xml in LIBVIRT_NETWORKS.items():
-    undefine_libvirt_network(net)
-    xmlpath = "/root/net-%s.xml" % net
-    open(xmlpath, "w").write(xml)
-    run_cmd(["virsh net-define %s" % xmlpath])
-    run_cmd(["virsh net-start %s" % net])
-    run_cmd(["virsh net-autostart %s" % net])
-
-def delete_all_vswitches():
+  libvirt_utils.create_libvirt_networks(libvirt_utils.get_connection(),
+                                        LIBVIRT_NETWORKS)
+
+def delete_all_vswitches(ifcfg_store=None):
   """
   Delete vswitches created by Nutanix.
+  If ifcfg_store is given, removal of the ifcfg files of the vswitches is only
+  staged in it, so that files which get regenerated with the same content are
+  left untouched on disk.
   Returns True if successful, Fatals otherwise.
   """
   # Get a list of bridges.
@@ -406,12 +408,42 @@ def delete_all_vswitches():
       cmd = ["ovs-vsctl del-br %s" % br]
       out = run_cmd(cmd)
 
-      ifcfgfile = "/etc/sysconfig/network-scripts/ifcfg-%s" % br
-      cmd = ["rm -f %s" % ifcfgfile]
-      out = run_cmd(cmd)
+      if ifcfg_store:
+        ifcfg_store.remove(br)
+      else:
+        ifcfgfile = "/etc/sysconfig/network-scripts/ifcfg-%s" % br
+        cmd = ["rm -f %s" % ifcfgfile]
+        out = run_cmd(cmd)
 
   return True
 
+def host_network_configured(cfg, ifcfg_store=None):
+  """
+  Returns True if the vswitches of cfg exist with ports attached and the
+  ifcfg files of the host interfaces carry the configured settings, i.e. if
+  the host side of cfg has already been applied.
+  """
+  out, _, ret = run_cmd_new(["ovs-vsctl list-br"], fatal=False, quiet=True)
+  if ret:
+    return False
+  bridges = out.split()
+  for vs in cfg.get("vswitches") or [{"name": "br0"}]:
+    if vs["name"] not in bridges:
+      return False
+    out, _, ret = run_cmd_new(["ovs-vsctl list-ports %s" % vs["name"]],
+                              fatal=False, quiet=True)
+    if ret or not out.strip():
+      return False
+
+  ifcfg_store = ifcfg_store or netUtil.IfcfgStore()
+  vswitch_mtus = netUtil.get_vswitch_mtus(cfg.get("vswitches"))
+  for iface in cfg["host_interfaces"]:
+    expected = netUtil.generate_ifcfg(iface, vswitch_mtus, is_ovs=True)
+    if not netUtil.ifcfg_contains(ifcfg_store.get_content(iface["name"]) or "",
+                                  expected):
+      return False
+  return True
+
 def get_mac_address(interface):
   """
   Get mac address of interface from cvm.
@@ -423,19 +455,38 @@ def get_mac_address(interface):
   out, _, _ = run_cmd_on_svm(cmd, dest_host="nutanix@192.168.5.254")
   return out
 
-def modify_active_slave_in_ovs_bond(target_ip, bond_name="br0-up",
-                                    arch="x86_64"):
+def get_cvm_mac_addresses():
   """
-  Modifies OVS bond to set active nic as the one which can reach a target
-  ip.
-  Args:
-    target_ip: IP address to ping in order to verify connectivity.
-
-  Raises:
-    StandardError if no nic which can reach target ip is found.
+  Get mac addresses of all interfaces of cvm with a single ssh call.
+  Returns dict mapping interface name to address.
+  """
+  # Output is of the form /sys/class/net/eth0/address:52:54:00:8a:0c:1e
+  cmd = "grep -H . /sys/class/net/*/address"
+  out, _, _ = run_cmd_on_svm(cmd, dest_host="nutanix@192.168.5.254")
+  addresses = {}
+  for line in out.splitlines():
+    path, _, mac = line.strip().partition(":")
+    if not mac:
+      continue
+    addresses[path.split("/")[-2]] = mac.lower()
+  return addresses
 
-  Return:
-    None
+def restart_cvm_interfaces(names, fatal=True):
+  """
+  Restarts interfaces names on the cvm with ifdown/ifup, in one ssh call.
+  Returns True if all interfaces came up, Fatals otherwise if fatal is set.
+  """
+  INFO("Restarting cvm interfaces %s" % ", ".join(names))
+  # ifdown fails for interfaces which are already down, ifup must not.
+  cmd = " && ".join("(sudo /sbin/ifdown %s; sudo /sbin/ifup %s)" % (name, name)
+                    for name in names)
+  _, _, ret = run_cmd_on_svm(cmd, dest_host="nutanix@192.168.5.254",
+                             attempts=1, fatal=fatal)
+  return not ret
+
+def get_ovs_bond_slaves(bond_name, arch="x86_64"):
+  """
+  Returns the slaves of an OVS bond as a list of (name, speed) tuples.
   """
   out, _, _ = run_cmd_new(["ovs-appctl", "bond/list"])
   # Output will be of the following form:
@@ -453,24 +504,72 @@ def modify_active_slave_in_ovs_bond(target_ip, bond_name="br0-up",
         speed = int(open(speed_file).read().strip())
         intfs.append((words[i], speed))
     break
+  return intfs
+
+def set_ovs_bond_active_slave(bond_name, intf):
+  """
+  Sets intf as the active slave of bond_name.
+  Returns True if successful, False otherwise.
+  """
+  _, _, ret = run_cmd_new(["ovs-appctl", "bond/set-active-slave",
+                          bond_name, intf], fatal=False)
+  if ret:
+    INFO("Failed to set %s as the active slave in bond %s"
+         % (intf, bond_name))
+    return False
+  return True
+
+def modify_active_slave_in_ovs_bond(target_ip, bond_name="br0-up",
+                                    arch="x86_64"):
+  """
+  Modifies OVS bond to set active nic as the one which can reach a target
+  ip.
+
+  All slaves are probed concurrently with ARP and the fastest slave which
+  can reach the target ip is made active. If no slave gets an ARP reply,
+  e.g. because the target ip is not on link, slaves are tried one by one
+  with ping.
+
+  Args:
+    target_ip: IP address to ping in order to verify connectivity.
+
+  Raises:
+    StandardError if no nic which can reach target ip is found.
+
+  Return:
+    None
+  """
+  intfs = [intf for intf in get_ovs_bond_slaves(bond_name, arch=arch)
+           if intf[1] > 0]
+
+  rtts = neighbor_utils.probe_arp([intf[0] for intf in intfs], target_ip)
+  if rtts:
+    # Prefer faster links, then faster responses.
+    reachable = sorted([intf for intf in intfs if intf[0] in rtts],
+                       key=lambda x: (-x[1], rtts[x[0]]))
+    for intf in reachable:
+      if set_ovs_bond_active_slave(bond_name, intf[0]):
+        INFO("Using %s as the active slave in bond %s, it reached %s in "
+             "%.1f ms" % (intf[0], bond_name, target_ip,
+                          rtts[intf[0]] * 1000))
+        return
+    raise StandardError("Could not set any interface which could reach "
+                        "target ip %s as the active slave" % target_ip)
 
   # Sort the nics according to speed and test connectivity.
+  INFO("No slave of %s got an ARP reply from %s, falling back to ping"
+       % (bond_name, target_ip))
   intfs = sorted(intfs, key=lambda x:x[1], reverse=True)
   active_nic = None
   for intf in intfs:
-    if intf[1] > 0:
-      _, _, ret = run_cmd_new(["ovs-appctl", "bond/set-active-slave",
-                              bond_name, intf[0]], fatal=False)
-      if ret:
-        INFO("Failed to set %s as the active slave in bond %s"
-             % (intf[0], bond_name))
-        continue
-      _, _, ret = run_cmd_new(["ping", "-c", "1", target_ip],
-                              timeout=60, attempts=5, fatal=False)
-      if not ret:
-        INFO("Using %s as the active slave in bond %s" % (intf[0], bond_name))
-        active_nic = intf[0]
-        break
+    if not set_ovs_bond_active_slave(bond_name, intf[0]):
+      continue
+    _, _, ret = run_cmd_new(["ping", "-c", "1", target_ip],
+                            timeout=60, attempts=5, fatal=False)
+    if not ret:
+      INFO("Using %s as the active slave in bond %s" % (intf[0], bond_name))
+      active_nic = intf[0]
+      break
 
   if not active_nic:
     raise StandardError("Could not find any interface which could reach "
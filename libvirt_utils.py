@@ -1,27 +1,196 @@
+import atexit
+import copy
 import libvirt
+import os
 import re
+import threading
+import time
 import xml.etree.ElementTree as et
 
 import log
 import kvm_net_utils
+import netUtil
+import trace_utils
 
 libvirtError = libvirt.libvirtError
+PCI_DEVICES_PATH = "/sys/bus/pci/devices"
+CVM_UUID_CACHE_PATH = "/root/nutanix-network-crashcart/cvm_uuid"
 libvirt_domain_update_flags = libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG
 
-def libvirt_connect():
+KEEPALIVE_INTERVAL_SECS = 5
+KEEPALIVE_COUNT = 3
+
+# Time to wait for the guest to release a hot unplugged device.
+DEVICE_REMOVAL_TIMEOUT_SECS = 60
+
+# Time to wait for hot plugged devices to show up in the domain.
+DEVICE_ATTACH_TIMEOUT_SECS = 60
+DEVICE_ATTACH_POLL_SECS = 0.5
+
+# PCI class of PCI-to-PCI bridges, which may share an IOMMU group with the
+# devices behind them.
+PCI_CLASS_BRIDGE = 0x0604
+
+# Process wide libvirt connection, see get_connection.
+_conn = None
+_conn_lock = threading.RLock()
+_event_loop_thread = None
+
+# Domain handles valid on _conn, keyed by UUID.
+_domains = {}
+_cvm_uuid = None
+
+# DomainXmlCache objects valid on _conn, keyed by domain UUID.
+_xml_caches = {}
+
+# CVM interface name to mac address map, see get_cvm_interface_map.
+_cvm_interface_map = None
+
+def _run_event_loop():
+  while True:
+    libvirt.virEventRunDefaultImpl()
+
+def start_event_loop():
+  """
+  Registers the default libvirt event loop implementation and runs it in a
+  daemon thread. The event loop is needed for keepalive and domain events,
+  and must be registered before the connection is opened.
+  """
+  global _event_loop_thread
+  with _conn_lock:
+    if _event_loop_thread:
+      return
+    libvirt.virEventRegisterDefaultImpl()
+    _event_loop_thread = threading.Thread(target=_run_event_loop,
+                                          name="libvirt-event-loop")
+    _event_loop_thread.daemon = True
+    _event_loop_thread.start()
+
+def _reset_connection():
+  global _conn
+  _conn = None
+  _domains.clear()
+  _xml_caches.clear()
+
+def _connection_closed(conn, reason, opaque):
+  log.INFO("libvirt connection closed, reason %s" % reason)
+  with _conn_lock:
+    if _conn is conn:
+      _reset_connection()
+
+def get_connection():
+  """
+  Returns the process wide libvirt connection, opening it on first use and
+  reopening it if it was lost, e.g. because libvirtd was restarted.
+  """
+  global _conn
+  with _conn_lock:
+    if _conn is not None:
+      try:
+        if _conn.isAlive():
+          return _conn
+      except libvirtError:
+        pass
+      log.INFO("libvirt connection lost, reconnecting")
+      _reset_connection()
+
+    start_event_loop()
+    try:
+      with trace_utils.span("libvirt.open", trace_utils.LIBVIRT):
+        conn = libvirt.open(None) # Uses LIBVIRT_DEFAULT_URI
+    except libvirtError as error:
+      log.FATAL("Failed to connect to libvirt: %s" % error)
+    try:
+      conn.setKeepAlive(KEEPALIVE_INTERVAL_SECS, KEEPALIVE_COUNT)
+      conn.registerCloseCallback(_connection_closed, None)
+    except libvirtError as error:
+      log.WARNING("Failed to enable libvirt keepalive: %s" % error)
+    _conn = conn
+    return _conn
+
+def close_connection():
   """
-  Establishes a libvirt connection and returns a handle or None.
+  Closes the process wide libvirt connection. Registered to run at exit.
   """
+  with _conn_lock:
+    conn = _conn
+    _reset_connection()
+  if conn is None:
+    return
   try:
-    return libvirt.open(None) # Uses LIBVIRT_DEFAULT_URI
+    conn.unregisterCloseCallback()
+    conn.close()
   except libvirtError as error:
-    log.FATAL("Failed to connect to libvirt: %s" % error)
+    log.DEBUG("Failed to close libvirt connection: %s" % error)
+
+atexit.register(close_connection)
+
+def libvirt_connect():
+  """
+  Returns the shared libvirt connection, see get_connection.
+  Callers must not close it.
+  """
+  return get_connection()
 
-def get_cvm_domain(conn):
+def get_domain(domain):
+  """
+  Returns a handle to domain which is valid on the current connection. Handles
+  obtained before a reconnect are looked up again by UUID.
+  """
+  conn = get_connection()
+  if domain.connect() is conn:
+    return domain
+  uuid = domain.UUIDString()
+  with _conn_lock:
+    if uuid not in _domains:
+      try:
+        _domains[uuid] = conn.lookupByUUIDString(uuid)
+      except libvirtError as error:
+        log.FATAL("Failed to look up domain %s: %s" % (uuid, error))
+    return _domains[uuid]
+
+def _read_cached_cvm_uuid():
+  try:
+    with open(CVM_UUID_CACHE_PATH) as fp:
+      return fp.read().strip() or None
+  except (IOError, OSError):
+    return None
+
+def _write_cached_cvm_uuid(uuid):
+  try:
+    netUtil.write_file_atomic(CVM_UUID_CACHE_PATH, uuid + "\n")
+  except (IOError, OSError) as error:
+    log.DEBUG("Failed to cache CVM UUID in %s: %s"
+              % (CVM_UUID_CACHE_PATH, error))
+
+@trace_utils.traced(trace_utils.LIBVIRT)
+def get_cvm_domain(conn=None):
   """
   Obtains a libvirt handle to the CVM domain, or None. This function presumes
   that there is only one domain named like .*-CVM on the host.
+
+  The handle is cached for as long as the connection lives, and the CVM UUID
+  is cached on disk across runs, so that the domain can be looked up
+  directly. All domains are scanned only if the cached UUID is gone.
   """
+  global _cvm_uuid
+  conn = get_connection()
+  with _conn_lock:
+    if _cvm_uuid in _domains:
+      return _domains[_cvm_uuid]
+
+  uuid = _read_cached_cvm_uuid()
+  if uuid:
+    try:
+      domain = conn.lookupByUUIDString(uuid)
+      if re.match(".*-CVM", domain.name()):
+        with _conn_lock:
+          _cvm_uuid = uuid
+          _domains[_cvm_uuid] = domain
+        return domain
+    except libvirtError as error:
+      log.INFO("Cached CVM domain %s not found: %s" % (uuid, error))
+
   try:
     domains = conn.listAllDomains(0)
   except libvirtError as error:
@@ -35,110 +204,578 @@ def get_cvm_domain(conn):
       continue
 
     if re.match(".*-CVM", name):
+      with _conn_lock:
+        _cvm_uuid = domain.UUIDString()
+        _domains[_cvm_uuid] = domain
+      _write_cached_cvm_uuid(_cvm_uuid)
       return domain
 
   log.FATAL("Could not find CVM domain")
 
-def detach_device(domain, xml):
+def xml_contains(expected, actual):
+  """
+  Returns True if every attribute and child element of expected is present
+  in actual. Elements added by libvirt, like uuid or mac, are ignored.
+
+  Args:
+    expected: ElementTree element describing the desired state.
+    actual: ElementTree element as returned by libvirt.
+  """
+  if expected.tag != actual.tag:
+    return False
+  for key, value in expected.attrib.items():
+    if actual.attrib.get(key) != value:
+      return False
+  if (expected.text or "").strip() != (actual.text or "").strip():
+    if (expected.text or "").strip():
+      return False
+  for child in expected:
+    if not any(xml_contains(child, candidate)
+               for candidate in actual.findall(child.tag)):
+      return False
+  return True
+
+def list_libvirt_networks(conn):
+  """
+  Returns a dict mapping network name to libvirt network handle.
+  """
+  try:
+    return dict((net.name(), net) for net in conn.listAllNetworks(0))
+  except libvirtError as error:
+    log.FATAL("Failed to list libvirt networks: %s" % error)
+
+@trace_utils.traced(trace_utils.LIBVIRT)
+def undefine_libvirt_network(conn, name, destroy=True, fatal=False,
+                             networks=None):
+  """
+  Destroys and undefines the libvirt network name, if it exists.
+
+  Args:
+    conn: libvirt connection.
+    name: Name of the network.
+    destroy: Stop the network if it is active.
+    fatal: Fatal if the network cannot be removed.
+    networks: Networks as returned by list_libvirt_networks, listed if None.
+  """
+  if networks is None:
+    networks = list_libvirt_networks(conn)
+  net = networks.pop(name, None)
+  if not net:
+    return
+  try:
+    if destroy and net.isActive():
+      net.destroy()
+    net.undefine()
+  except libvirtError as error:
+    if fatal:
+      log.FATAL("Failed to undefine libvirt network %s: %s" % (name, error))
+    else:
+      log.ERROR("Failed to undefine libvirt network %s: %s" % (name, error))
+
+@trace_utils.traced(trace_utils.LIBVIRT)
+def define_libvirt_network(conn, xml, networks=None):
+  """
+  Defines, starts and autostarts the libvirt network described by xml.
+  A network which already matches xml is left as is, apart from being
+  started and marked autostart if needed.
+
+  Args:
+    conn: libvirt connection.
+    xml: Network xml.
+    networks: Networks as returned by list_libvirt_networks, listed if None.
+  """
+  if networks is None:
+    networks = list_libvirt_networks(conn)
+  expected = et.fromstring(xml)
+  # Number of connections is runtime state reported by libvirt.
+  expected.attrib.pop("connections", None)
+  name = expected.find("./name").text
+  try:
+    net = networks.get(name)
+    if net and xml_contains(expected, et.fromstring(net.XMLDesc(0))):
+      log.INFO("libvirt network %s is already defined" % name)
+    else:
+      undefine_libvirt_network(conn, name, networks=networks, fatal=True)
+      log.INFO("Defining libvirt network %s" % name)
+      net = conn.networkDefineXML(xml)
+      networks[name] = net
+    if not net.isActive():
+      net.create()
+    if not net.autostart():
+      net.setAutostart(1)
+  except libvirtError as error:
+    log.FATAL("Failed to define libvirt network %s: %s" % (name, error))
+  return net
+
+def create_libvirt_networks(conn, network_xmls):
+  """
+  Makes network_xmls the only libvirt networks apart from user defined ones,
+  using a single connection and a single listing of existing networks.
+
+  Args:
+    conn: libvirt connection.
+    network_xmls: Dict mapping network name to network xml.
+  """
+  networks = list_libvirt_networks(conn)
+
+  # Delete "default" network installed by libvirt.
+  undefine_libvirt_network(conn, "default", networks=networks)
+
+  for xml in network_xmls.values():
+    define_libvirt_network(conn, xml, networks=networks)
+
+def normalize_pci_address(address):
+  """
+  Returns PCI bus address, eg. 86:00.0, in canonical bb:ss.f form.
+  """
+  bus, slot, func = re.split("\.|:", address)[-3:]
+  return "%02x:%02x.%x" % (int(bus, 16), int(slot, 16), int(func, 16))
+
+class DomainXmlCache(object):
+  """
+  Parsed view of the live XML of a domain, with PCI host devices indexed by
+  bus address and interfaces indexed by mac address.
+
+  The view is parsed on first use and dropped when libvirt reports that a
+  device was added to or removed from the domain, as well as after every
+  device change made through this module. Callers must not modify the
+  returned elements.
+
+  The same events are used to wait for the guest to complete a hot unplug,
+  see expect_removal.
+  """
+  def __init__(self, domain):
+    self.domain = domain
+    self._lock = threading.Lock()
+    self._xmldesc = None
+    self._hostdevs = None
+    self._interfaces = None
+    # Pending hot unplugs, keyed by device alias.
+    self._removals = {}
+    self._callback_ids = []
+    conn = domain.connect()
+    for event, callback in (
+        ("VIR_DOMAIN_EVENT_ID_DEVICE_ADDED", self._device_event),
+        ("VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED", self._device_removed),
+        ("VIR_DOMAIN_EVENT_ID_DEVICE_REMOVAL_FAILED",
+         self._device_removal_failed)):
+      # Older libvirt does not know about all device events. Changes made
+      # through this module still invalidate the view.
+      if not hasattr(libvirt, event):
+        continue
+      try:
+        self._callback_ids.append(conn.domainEventRegisterAny(
+            domain, getattr(libvirt, event), callback, None))
+      except libvirtError as error:
+        log.WARNING("Failed to register for %s: %s" % (event, error))
+    self.removal_events = bool(self._callback_ids)
+
+  def _device_event(self, conn, domain, dev_alias, opaque):
+    self.invalidate()
+
+  def _device_removed(self, conn, domain, dev_alias, opaque):
+    self.invalidate()
+    with self._lock:
+      removal = self._removals.pop(dev_alias, None)
+    if removal:
+      removal["event"].set()
+
+  def _device_removal_failed(self, conn, domain, dev_alias, opaque):
+    with self._lock:
+      removal = self._removals.pop(dev_alias, None)
+    if removal:
+      removal["failed"] = True
+      removal["event"].set()
+
+  def expect_removal(self, alias):
+    """
+    Registers interest in the removal of device alias. Must be called before
+    the detach is requested, so that the event cannot be missed.
+    """
+    removal = {"event": threading.Event(), "failed": False}
+    with self._lock:
+      self._removals[alias] = removal
+    return removal
+
+  def wait_for_removal(self, alias, removal, timeout):
+    """
+    Waits for the removal registered with expect_removal.
+    Returns True if the guest released the device, False otherwise.
+    """
+    removal["event"].wait(timeout)
+    with self._lock:
+      self._removals.pop(alias, None)
+    if removal["failed"]:
+      log.ERROR("Guest failed to release device %s" % alias)
+      return False
+    if removal["event"].is_set():
+      return True
+    # The event may have been lost, e.g. on a reconnect. Check the domain.
+    self.invalidate()
+    for desc in self.xmldesc().findall("./devices/*/alias"):
+      if desc.attrib.get("name") == alias:
+        log.ERROR("Device %s was not released by the guest within %s seconds"
+                  % (alias, timeout))
+        return False
+    return True
+
+  def invalidate(self):
+    with self._lock:
+      self._xmldesc = None
+      self._hostdevs = None
+      self._interfaces = None
+
+  def _load(self):
+    with self._lock:
+      if self._xmldesc is None:
+        try:
+          with trace_utils.span("XMLDesc", trace_utils.LIBVIRT):
+            xmldesc = et.fromstring(self.domain.XMLDesc(0))
+        except libvirtError as error:
+          log.FATAL("Failed to get domain XML: %s" % error)
+        self._hostdevs = index_hostdevs_by_address(xmldesc)
+        self._interfaces = index_interfaces_by_mac(xmldesc)
+        self._xmldesc = xmldesc
+      return self._xmldesc, self._hostdevs, self._interfaces
+
+  def xmldesc(self):
+    return self._load()[0]
+
+  def hostdevs(self):
+    """
+    Returns a dict mapping PCI bus address to hostdev element.
+    """
+    return self._load()[1]
+
+  def interfaces(self):
+    """
+    Returns a dict mapping mac address to interface element.
+    """
+    return self._load()[2]
+
+  def close(self):
+    conn = self.domain.connect()
+    for callback_id in self._callback_ids:
+      try:
+        conn.domainEventDeregisterAny(callback_id)
+      except libvirtError:
+        pass
+    self._callback_ids = []
+
+def get_domain_xml_cache(domain):
+  """
+  Returns the DomainXmlCache of domain on the current connection.
+  """
+  domain = get_domain(domain)
+  uuid = domain.UUIDString()
+  with _conn_lock:
+    if uuid not in _xml_caches:
+      _xml_caches[uuid] = DomainXmlCache(domain)
+    return _xml_caches[uuid]
+
+def invalidate_domain_xml(domain):
+  with _conn_lock:
+    cache = _xml_caches.get(domain.UUIDString())
+  if cache:
+    cache.invalidate()
+
+@trace_utils.traced(trace_utils.LIBVIRT)
+def detach_device(domain, xml, flags=libvirt_domain_update_flags,
+                  timeout=DEVICE_REMOVAL_TIMEOUT_SECS):
+  """
+  Detaches device xml from domain.
+
+  Hot unplug completes asynchronously in the guest. When the live domain is
+  affected and xml carries the device alias, this blocks until libvirt
+  reports that the device was removed, or timeout seconds pass.
+
+  Returns True if the device is gone, False if the guest did not release it.
+  """
+  domain = get_domain(domain)
+  alias_desc = et.fromstring(xml).find("./alias")
+  removal = None
+  cache = None
+  if (flags & libvirt.VIR_DOMAIN_AFFECT_LIVE and alias_desc is not None and
+      timeout):
+    cache = get_domain_xml_cache(domain)
+    if cache.removal_events and domain.isActive():
+      removal = cache.expect_removal(alias_desc.attrib["name"])
   try:
-    domain.detachDeviceFlags(xml, libvirt_domain_update_flags)
+    domain.detachDeviceFlags(xml, flags)
   except libvirtError as ex:
     log.FATAL("Failed to detach %s : %s" % (xml, ex))
+  finally:
+    invalidate_domain_xml(domain)
+  if removal:
+    return cache.wait_for_removal(alias_desc.attrib["name"], removal, timeout)
+  return True
 
-def attach_device(domain, xml):
+@trace_utils.traced(trace_utils.LIBVIRT)
+def attach_device(domain, xml, flags=libvirt_domain_update_flags):
   try:
-    domain.attachDeviceFlags(xml, libvirt_domain_update_flags)
+    get_domain(domain).attachDeviceFlags(xml, flags)
   except libvirtError as ex:
     log.FATAL("Failed to attach %s : %s" % (xml, ex))
+  finally:
+    invalidate_domain_xml(domain)
 
-def update_device_xml(domain, old_xml, new_xml):
-  detach_device(domain, old_xml)
-  attach_device(domain, new_xml)
+@trace_utils.traced(trace_utils.LIBVIRT)
+def update_device_xml(domain, old_xml, new_xml,
+                      flags=libvirt_domain_update_flags):
+  """
+  Replaces device old_xml of domain with new_xml.
 
-def update_cvm_domain(domain, cfg):
+  The device is first updated in place with updateDeviceFlags, which keeps it
+  plugged into the guest when only modifiable attributes, like the source
+  bridge or vlan tag of a NIC, change. If libvirt cannot apply the change in
+  place the device is detached and attached again. Device names in new_xml,
+  which are needed to match the device in place, are dropped for the attach.
   """
-  Find network interface corresponding to eth_dev and add br_name, vlan_tag.
-  Return True if successful, False otherwise.
-  Ethernet devices are matched by mac addresses and no dependency is kept on
-  ordering of devices.
+  try:
+    get_domain(domain).updateDeviceFlags(new_xml, flags)
+    return
+  except libvirtError as ex:
+    log.INFO("Unable to update device in place, replacing it: %s" % ex)
+  finally:
+    invalidate_domain_xml(domain)
+
+  new_desc = et.fromstring(new_xml)
+  for element in new_desc.findall("./alias") + new_desc.findall("./target"):
+    new_desc.remove(element)
+  if not detach_device(domain, old_xml, flags=flags):
+    log.FATAL("Device was not released by the guest, cannot attach %s"
+              % new_xml)
+  attach_device(domain, et.tostring(new_desc), flags=flags)
+
+def get_domain_interface_macs(domain):
   """
-  log.INFO("Updating cvm xml file for network devices")
+  Returns the set of mac addresses of the interfaces in the domain XML.
+  """
+  return set(get_domain_xml_cache(domain).interfaces())
 
-  cvm_interfaces = cfg["cvm_interfaces"]
-  name_mac_map = {}
-  for interface in cvm_interfaces:
-    if interface["vswitch"] == "_internal_":
-      continue
-    out = kvm_net_utils.get_mac_address(interface["name"])
-    mac_addr = out.strip()
-    name_mac_map[interface["name"]] = mac_addr
+@trace_utils.traced(trace_utils.LIBVIRT)
+def get_guest_agent_interface_map(domain):
+  """
+  Returns a dict mapping guest interface name to mac address as reported by
+  the qemu guest agent, or an empty dict if the agent is not available.
+  """
+  try:
+    interfaces = get_domain(domain).interfaceAddresses(
+        libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT, 0)
+  except (AttributeError, libvirtError) as error:
+    log.DEBUG("Guest agent interface query failed: %s" % error)
+    return {}
+  return dict((name, info["hwaddr"].lower())
+              for name, info in interfaces.items() if info.get("hwaddr"))
 
+def get_cvm_interface_map(domain, names=None, refresh=False):
+  """
+  Returns a dict mapping CVM interface name to mac address, for the
+  interfaces present in the domain XML. The result is cached for the run.
 
-  xmldesc = et.fromstring(domain.XMLDesc(0))
+  The guest agent is asked first. If it is not available, or does not know
+  about all of names, the addresses are read from the CVM with one ssh call.
 
-  for interface in cvm_interfaces:
-    mac_addr = name_mac_map[interface["name"]]
-    vlan_tag = interface["vlan"]
-    if vlan_tag is not None and int(vlan_tag) >= 0 and int(vlan_tag) <= 4095:
-      vlan_tag = str(vlan_tag)
-    else:
-      vlan_tag = None
+  Args:
+    domain: CVM domain.
+    names: Interface names the caller needs.
+    refresh: Ignore the cached map.
+  """
+  global _cvm_interface_map
+  names = names or []
+  if (_cvm_interface_map is not None and not refresh and
+      all(name in _cvm_interface_map for name in names)):
+    return _cvm_interface_map
 
-    vswitch = interface["vswitch"]
+  domain_macs = get_domain_interface_macs(domain)
+  interface_map = get_guest_agent_interface_map(domain)
+  if not interface_map or any(name not in interface_map for name in names):
+    interface_map = kvm_net_utils.get_cvm_mac_addresses()
+
+  _cvm_interface_map = dict((name, mac) for name, mac in interface_map.items()
+                            if mac in domain_macs)
+  return _cvm_interface_map
 
-    found = False
-    for desc in xmldesc.findall("./devices/interface"):
-      if ((desc.attrib["type"] == "bridge" and
+def clear_cvm_interface_map():
+  """
+  Drops the map cached by get_cvm_interface_map, for processes which outlive
+  a run, as the CVM may renumber its interfaces when it reboots.
+  """
+  global _cvm_interface_map
+  _cvm_interface_map = None
+
+def is_external_interface(desc):
+  """
+  Returns True if interface element desc is an external CVM NIC, i.e. it is
+  connected to a vswitch or to a libvirt network other than the local one.
+  """
+  return ((desc.attrib["type"] == "bridge" and
            desc.find("./source").attrib["bridge"] in
-           kvm_net_utils.VALID_VSWITCHES or
-           (desc.attrib["type"] == "network" and
-            desc.find("./source").attrib["network"] != "NTNX-Local-Network"))):
+           kvm_net_utils.VALID_VSWITCHES) or
+          (desc.attrib["type"] == "network" and
+           desc.find("./source").attrib["network"] != "NTNX-Local-Network"))
 
-        old_xml = et.tostring(desc)
+def index_hostdevs_by_address(xmldesc):
+  """
+  Returns a dict mapping PCI bus address to hostdev element of domain xml.
+  """
+  hostdevs = {}
+  for desc in xmldesc.findall("./devices/hostdev"):
+    src_address = desc.find("./source/address")
+    if (src_address is None or
+        src_address.attrib.get("domain") != "0x0000"):
+      continue
+    address = normalize_pci_address("%s:%s.%s" % (
+        src_address.attrib["bus"], src_address.attrib["slot"],
+        src_address.attrib["function"]))
+    hostdevs[address] = desc
+  return hostdevs
 
-        if desc.find("./mac").attrib["address"] != mac_addr:
-          continue
+def index_interfaces_by_mac(xmldesc):
+  """
+  Returns a dict mapping mac address to interface element of domain xml.
+  """
+  return dict((desc.find("./mac").attrib["address"].lower(), desc)
+              for desc in xmldesc.findall("./devices/interface"))
 
-        found = True
+def get_interface_vlan_tag(desc):
+  vlandesc = desc.find("./vlan/tag")
+  if vlandesc is None:
+    return None
+  return vlandesc.attrib["id"]
 
-        # Force interface type to be bridge.
-        desc.attrib["type"] = "bridge"
-        map(desc.remove, desc.findall("./source"))
-        et.SubElement(desc, "source", {"bridge": vswitch})
+def interface_matches(desc, vswitch, vlan_tag):
+  """
+  Returns True if interface element desc is already an OVS port on vswitch
+  with vlan_tag.
+  """
+  source = desc.find("./source")
+  virtualport = desc.find("./virtualport")
+  return (desc.attrib["type"] == "bridge" and
+          source is not None and source.attrib.get("bridge") == vswitch and
+          virtualport is not None and
+          virtualport.attrib.get("type") == "openvswitch" and
+          get_interface_vlan_tag(desc) == vlan_tag)
 
-        # Delete QEMU/libvirt assigned device names, let it pick a new one.
-        map(desc.remove, desc.findall("./alias"))
-        map(desc.remove, desc.findall("./target"))
+def set_interface_bridge(desc, vswitch, vlan_tag, in_place=False):
+  """
+  Turns interface element desc into an OVS port on vswitch with vlan_tag.
 
-        # Delete OVS related stuff such as UUIDs.
-        map(desc.remove, desc.findall("./virtualport"))
-        et.SubElement(desc, "virtualport", {"type": "openvswitch"})
+  If in_place is True, device names and an existing OVS port identity are
+  kept, so that the result can be applied to the running domain with
+  updateDeviceFlags.
+  """
+  # Force interface type to be bridge.
+  desc.attrib["type"] = "bridge"
+  for source in desc.findall("./source"):
+    desc.remove(source)
+  et.SubElement(desc, "source", {"bridge": vswitch})
 
-        # Add vlan tagging.
-        vlandesc = desc.find("./vlan")
-        if vlan_tag and not vlandesc: # Add vlan tag.
-          vlandesc = et.SubElement(desc, "vlan")
-          et.SubElement(vlandesc, "tag", {"id": vlan_tag})
-        elif not vlan_tag and vlandesc: # Remove vlan tag.
-          desc.remove(vlandesc)
-        elif (vlan_tag and vlandesc and
-              vlandesc.find("./tag").attrib["id"] != vlan_tag): # Change tag.
-          desc.remove(vlandesc)
-          vlandesc = et.SubElement(desc, "vlan")
-          et.SubElement(vlandesc, "tag", {"id": vlan_tag})
+  if not in_place:
+    # Delete QEMU/libvirt assigned device names, let it pick a new one.
+    for element in desc.findall("./alias") + desc.findall("./target"):
+      desc.remove(element)
 
-        new_xml = et.tostring(desc)
+  virtualport = desc.find("./virtualport")
+  if (not in_place or virtualport is None or
+      virtualport.attrib.get("type") != "openvswitch"):
+    # Delete OVS related stuff such as UUIDs.
+    for virtualport in desc.findall("./virtualport"):
+      desc.remove(virtualport)
+    et.SubElement(desc, "virtualport", {"type": "openvswitch"})
 
-        log.INFO("Replacing external NIC %s in CVM" % interface["name"])
-        update_device_xml(domain, old_xml, new_xml)
+  # Set vlan tagging.
+  for vlandesc in desc.findall("./vlan"):
+    desc.remove(vlandesc)
+  if vlan_tag:
+    vlandesc = et.SubElement(desc, "vlan")
+    et.SubElement(vlandesc, "tag", {"id": vlan_tag})
 
-        log.INFO("CVM external NIC %s successfully updated" % interface["name"])
-        break
-    if not found:
+def get_cfg_vlan_tag(interface):
+  """
+  Returns the vlan tag of cvm interface entry of the configuration json as
+  it appears in domain XML, or None if the interface is untagged.
+  """
+  vlan_tag = interface["vlan"]
+  if vlan_tag is not None and int(vlan_tag) >= 0 and int(vlan_tag) <= 4095:
+    return str(vlan_tag)
+  return None
+
+@trace_utils.traced(trace_utils.LIBVIRT)
+def update_cvm_domain(domain, cfg):
+  """
+  Find network interface corresponding to eth_dev and add br_name, vlan_tag.
+  Return True if successful, False otherwise.
+  Ethernet devices are matched by mac addresses and no dependency is kept on
+  ordering of devices.
+
+  The persistent definition is updated with a single defineXML, and only the
+  interfaces which differ in the running domain are replaced live.
+  """
+  log.INFO("Updating cvm xml file for network devices")
+
+  domain = get_domain(domain)
+  cvm_interfaces = [interface for interface in cfg["cvm_interfaces"]
+                    if interface["vswitch"] != "_internal_"]
+  name_mac_map = get_cvm_interface_map(
+      domain, [interface["name"] for interface in cvm_interfaces])
+
+  try:
+    config_xmldesc = et.fromstring(domain.XMLDesc(
+        libvirt.VIR_DOMAIN_XML_INACTIVE | libvirt.VIR_DOMAIN_XML_SECURE))
+    active = domain.isActive()
+  except libvirtError as error:
+    log.FATAL("Failed to get CVM domain XML: %s" % error)
+
+  config_index = index_interfaces_by_mac(config_xmldesc)
+  live_index = {}
+  if active:
+    live_index = get_domain_xml_cache(domain).interfaces()
+
+  config_changed = False
+  live_updates = []
+  for interface in cvm_interfaces:
+    mac_addr = name_mac_map.get(interface["name"])
+    if not mac_addr:
+      log.FATAL("Could not find mac address of CVM interface %s"
+                % interface["name"])
+    vlan_tag = get_cfg_vlan_tag(interface)
+    vswitch = interface["vswitch"]
+
+    desc = config_index.get(mac_addr)
+    if desc is None or not is_external_interface(desc):
       log.FATAL("Could not find external NIC in CVM XML descriptor")
+    if not interface_matches(desc, vswitch, vlan_tag):
+      set_interface_bridge(desc, vswitch, vlan_tag)
+      config_changed = True
 
-  return True
+    live_desc = live_index.get(mac_addr)
+    if live_desc is not None and not interface_matches(live_desc, vswitch,
+                                                       vlan_tag):
+      old_xml = et.tostring(live_desc)
+      live_desc = copy.deepcopy(live_desc)
+      set_interface_bridge(live_desc, vswitch, vlan_tag, in_place=True)
+      live_updates.append((interface["name"], old_xml,
+                           et.tostring(live_desc)))
+
+  if config_changed:
+    log.INFO("Updating persistent CVM definition")
+    try:
+      domain.connect().defineXML(et.tostring(config_xmldesc))
+    except libvirtError as error:
+      log.FATAL("Failed to define CVM domain: %s" % error)
+    finally:
+      invalidate_domain_xml(domain)
 
+  for name, old_xml, new_xml in live_updates:
+    log.INFO("Replacing external NIC %s in CVM" % name)
+    update_device_xml(domain, old_xml, new_xml,
+                      flags=libvirt.VIR_DOMAIN_AFFECT_LIVE)
+    log.INFO("CVM external NIC %s successfully updated" % name)
+
+  if not config_changed and not live_updates:
+    log.INFO("CVM external NICs are already up to date")
+  return True
 
 def configure_cvm_interfaces(cfg):
   """
@@ -147,37 +784,265 @@ def configure_cvm_interfaces(cfg):
   """
 
   log.INFO("Configuring cvm interfaces")
-  conn = libvirt_connect()
-  domain = get_cvm_domain(conn)
+  domain = get_cvm_domain()
   update_cvm_domain(domain, cfg)
-  conn.close()
   return True
 
-def attach_passthru_device(domain, address):
+def capture_domain_network(domain):
+  """
+  Captures the persistent definition of domain and the XML of its live
+  interfaces, see restore_domain_network.
+
+  Returns:
+    Dict with the inactive domain XML under config_xml and a dict mapping mac
+    address to live interface XML under interfaces.
+  """
+  domain = get_domain(domain)
+  try:
+    config_xml = domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE |
+                                libvirt.VIR_DOMAIN_XML_SECURE)
+    active = domain.isActive()
+  except libvirtError as error:
+    log.FATAL("Failed to get domain XML: %s" % error)
+  interfaces = {}
+  if active:
+    for mac, desc in get_domain_xml_cache(domain).interfaces().items():
+      interfaces[mac] = et.tostring(desc)
+  return {"config_xml": config_xml, "interfaces": interfaces}
+
+@trace_utils.traced(trace_utils.LIBVIRT)
+def restore_domain_network(domain, snapshot):
+  """
+  Restores a state captured by capture_domain_network: the persistent
+  definition with a single defineXML, and the live interfaces which differ
+  from the snapshot in place. Errors are logged, not fatal, so that a
+  rollback restores as much as it can.
+
+  Returns True if everything was restored.
+  """
+  domain = get_domain(domain)
+  restored = True
+  try:
+    current = domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE |
+                             libvirt.VIR_DOMAIN_XML_SECURE)
+    if current != snapshot["config_xml"]:
+      log.INFO("Restoring persistent definition of %s" % domain.name())
+      domain.connect().defineXML(snapshot["config_xml"])
+  except libvirtError as error:
+    log.ERROR("Failed to restore domain definition: %s" % error)
+    restored = False
+  finally:
+    invalidate_domain_xml(domain)
+
+  if snapshot["interfaces"] and domain.isActive():
+    live_index = get_domain_xml_cache(domain).interfaces()
+    for mac, xml in sorted(snapshot["interfaces"].items()):
+      desc = live_index.get(mac)
+      if desc is None or et.tostring(desc) == xml:
+        continue
+      log.INFO("Restoring live interface %s" % mac)
+      try:
+        domain.updateDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+      except libvirtError as error:
+        log.ERROR("Failed to restore interface %s: %s" % (mac, error))
+        restored = False
+    invalidate_domain_xml(domain)
+  return restored
+
+def cvm_interfaces_configured(cfg):
+  """
+  Returns True if all external cvm interfaces of cfg are already attached to
+  their vswitch and vlan in the running CVM.
+  """
+  domain = get_cvm_domain()
+  cvm_interfaces = [interface for interface in cfg["cvm_interfaces"]
+                    if interface["vswitch"] != "_internal_"]
+  name_mac_map = get_cvm_interface_map(
+      domain, [interface["name"] for interface in cvm_interfaces])
+  live_index = get_domain_xml_cache(domain).interfaces()
+  for interface in cvm_interfaces:
+    desc = live_index.get(name_mac_map.get(interface["name"]))
+    if desc is None or not interface_matches(desc, interface["vswitch"],
+                                             get_cfg_vlan_tag(interface)):
+      return False
+  return True
+
+def build_passthru_device_xml(address):
+  """
+  Returns the hostdev xml to pass through PCI device address eg. 86:00.0.
+  """
   bus, slot, func = re.split("\.|:", address)
-  xmldesc = et.fromstring(domain.XMLDesc(0))
-  devices_desc = xmldesc.find("./devices")
-  hostdev_desc = et.SubElement(devices_desc, "hostdev", {"mode": "subsystem",
-                                                         "type": "pci",
-                                                         "managed": "yes"})
+  hostdev_desc = et.Element("hostdev", {"mode": "subsystem",
+                                        "type": "pci",
+                                        "managed": "yes"})
   source_desc = et.SubElement(hostdev_desc, "source", {})
   et.SubElement(source_desc, "address", {"domain": "0x0000",
                                          "bus": "0x" + bus,
                                          "slot": "0x" + slot,
                                          "function": "0x" + func})
   et.SubElement(hostdev_desc, "rom", {"bar": "off"})
-  attach_device(domain, et.tostring(hostdev_desc))
+  return et.tostring(hostdev_desc)
 
-def get_host_device_xml(domain, address):
-  bus, slot, func = re.split("\.|:", address)
+def attach_passthru_device(domain, address):
+  attach_device(domain, build_passthru_device_xml(address))
 
-  xmldesc = et.fromstring(domain.XMLDesc(0))
-  for desc in xmldesc.findall("./devices/hostdev"):
-    dev_xml = et.tostring(desc)
-    src_address = desc.find("./source/address")
-    if (src_address.attrib["domain"] == "0x0000" and
-        src_address.attrib["bus"] == "0x%s" % bus and
-        src_address.attrib["slot"] == "0x%s" % slot and
-        src_address.attrib["function"] == "0x%s" % func):
-      return desc, dev_xml
-  return None, None
+def validate_iommu_groups(addresses):
+  """
+  Checks that every PCI device in addresses can be passed through, i.e. it
+  has an IOMMU group and all other endpoints of the group are passed through
+  as well.
+
+  Args:
+    addresses: List of PCI bus addresses eg. 86:00.0.
+
+  Returns:
+    List of error messages, empty if the devices can be passed through.
+  """
+  errors = []
+  addresses = set(normalize_pci_address(address) for address in addresses)
+  for address in sorted(addresses):
+    device_path = os.path.join(PCI_DEVICES_PATH, "0000:%s" % address)
+    group_path = os.path.join(device_path, "iommu_group", "devices")
+    if not os.path.exists(device_path):
+      errors.append("PCI device %s does not exist" % address)
+      continue
+    if not os.path.isdir(group_path):
+      errors.append("PCI device %s is not in an IOMMU group, is IOMMU "
+                    "enabled?" % address)
+      continue
+    for member in os.listdir(group_path):
+      member_address = normalize_pci_address(member)
+      if member_address in addresses:
+        continue
+      try:
+        with open(os.path.join(PCI_DEVICES_PATH, member, "class")) as fp:
+          pci_class = int(fp.read().strip(), 16) >> 8
+      except (IOError, OSError, ValueError):
+        pci_class = None
+      if pci_class != PCI_CLASS_BRIDGE:
+        errors.append("PCI device %s shares IOMMU group with %s which is not "
+                      "passed through" % (address, member_address))
+  return errors
+
+@trace_utils.traced(trace_utils.LIBVIRT)
+def attach_passthru_devices(domain, addresses, original=None,
+                            timeout=DEVICE_ATTACH_TIMEOUT_SECS):
+  """
+  Passes through a set of PCI devices to domain as one transaction.
+
+  IOMMU groups are validated before anything is changed. All attaches are
+  then issued back to back, and the domain is watched until every device
+  shows up. If any step fails, the hostdevs of the domain are restored to
+  original.
+
+  Args:
+    domain: libvirt domain.
+    addresses: List of PCI bus addresses eg. 86:00.0.
+    original: Set of PCI bus addresses to restore on failure. Defaults to
+        the hostdevs of the domain when called, callers which detached
+        devices beforehand pass the set from before the detach.
+    timeout: Seconds to wait for the devices to show up.
+
+  Returns:
+    True if all devices were passed through, False otherwise.
+  """
+  domain = get_domain(domain)
+  addresses = [normalize_pci_address(address) for address in addresses]
+  cache = get_domain_xml_cache(domain)
+  current = set(cache.hostdevs())
+  if original is None:
+    original = current
+  original = set(normalize_pci_address(address) for address in original)
+
+  errors = validate_iommu_groups(addresses)
+  if errors:
+    for error in errors:
+      log.ERROR(error)
+    if original != current and not restore_passthru_devices(domain,
+                                                            original):
+      log.ERROR("PCI host devices of domain were only partially restored")
+    return False
+
+  pending = [address for address in addresses if address not in current]
+  if not pending:
+    return True
+
+  attached = []
+  try:
+    for address in pending:
+      log.INFO("Passing through PCI device %s" % address)
+      domain.attachDeviceFlags(build_passthru_device_xml(address),
+                               libvirt_domain_update_flags)
+      attached.append(address)
+    cache.invalidate()
+
+    deadline = time.time() + timeout
+    while True:
+      missing = [address for address in pending
+                 if address not in cache.hostdevs()]
+      if not missing:
+        log.INFO("Passed through PCI devices %s" % ", ".join(pending))
+        return True
+      if time.time() >= deadline:
+        log.ERROR("PCI devices %s did not show up in domain within %s "
+                  "seconds" % (", ".join(missing), timeout))
+        break
+      trace_utils.sleep(DEVICE_ATTACH_POLL_SECS, "wait_for_attach")
+      cache.invalidate()
+  except libvirtError as ex:
+    log.ERROR("Failed to pass through PCI devices: %s" % ex)
+  finally:
+    cache.invalidate()
+
+  if not restore_passthru_devices(domain, original):
+    log.ERROR("PCI host devices of domain were only partially restored")
+  return False
+
+@trace_utils.traced(trace_utils.LIBVIRT)
+def restore_passthru_devices(domain, original):
+  """
+  Restores the PCI hostdevs of domain to original.
+
+  Errors are logged, not fatal, and the remaining devices are still
+  restored, like restore_domain_network.
+
+  Args:
+    domain: libvirt domain.
+    original: Set of PCI bus addresses passed through before.
+
+  Returns:
+    True if everything was restored.
+  """
+  log.INFO("Restoring PCI host devices of domain")
+  domain = get_domain(domain)
+  try:
+    current = dict((address, et.tostring(desc)) for address, desc in
+                   index_hostdevs_by_address(
+                       et.fromstring(domain.XMLDesc(0))).items())
+  except libvirtError as error:
+    log.ERROR("Failed to get domain XML: %s" % error)
+    return False
+
+  restored = True
+  changes = ([(address, "detach", xml) for address, xml in
+              sorted(current.items()) if address not in original] +
+             [(address, "attach", build_passthru_device_xml(address))
+              for address in sorted(original) if address not in current])
+  for address, action, xml in changes:
+    try:
+      if action == "detach":
+        domain.detachDeviceFlags(xml, libvirt_domain_update_flags)
+      else:
+        domain.attachDeviceFlags(xml, libvirt_domain_update_flags)
+    except libvirtError as error:
+      log.ERROR("Failed to %s PCI device %s: %s" % (action, address, error))
+      restored = False
+  invalidate_domain_xml(domain)
+  return restored
+
+def get_host_device_xml(domain, address):
+  desc = get_domain_xml_cache(domain).hostdevs().get(
+      normalize_pci_address(address))
+  if desc is None:
+    return None, None
+  return desc, et.tostring(desc)
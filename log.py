@@ -6,21 +6,26 @@
 # Installer log library.
 #
 
+import atexit
+import collections
+import gzip
+import io
 import logging
 import os
 import sys
 import threading
+import time
 import socket
 
 try:
   # Py3 for ESXi 6.5.
-  from urllib.parse import quote
-  from urllib.request import urlopen, Request
-  from urllib.error import URLError
+  from http.client import HTTPConnection, HTTPSConnection, HTTPException
+  from urllib.parse import quote, urlsplit
 except ImportError:
   # Py2 for phoenix and others.
+  from httplib import HTTPConnection, HTTPSConnection, HTTPException
   from urllib import quote
-  from urllib2 import urlopen, Request, URLError
+  from urlparse import urlsplit
 
 monitoring_url_root = None
 monitoring_log_offset = 0
@@ -28,6 +33,39 @@ monitoring_offset_lock = threading.Lock()
 monitoring_url_timeout_secs = 5
 monitoring_url_retry_count = 5
 
+# Messages are posted by a background sender. Messages queued within
+# monitoring_flush_interval_secs of each other are posted together.
+monitoring_flush_interval_secs = 0.5
+# Messages queued beyond MONITORING_QUEUE_SIZE are dropped, except errors
+# which may use MONITORING_QUEUE_RESERVE more entries.
+MONITORING_QUEUE_SIZE = 1000
+MONITORING_QUEUE_RESERVE = 100
+MONITORING_URGENT_STEPS = ("error", "fatal")
+# Seconds FATAL and exit wait for queued messages to be posted.
+MONITORING_FLUSH_TIMEOUT_SECS = 10
+
+# Request bodies are gzip compressed if set.
+monitoring_gzip = False
+
+# Connections to monitoring servers are kept open between posts, keyed by
+# (scheme, netloc). A connection is taken out while it is in use.
+monitoring_connections = {}
+monitoring_connections_lock = threading.Lock()
+monitoring_stats = {"posts": 0, "failures": 0, "bytes_sent": 0,
+                    "bytes_logged": 0, "connections": 0, "reconnects": 0,
+                    "first_post_time": None, "last_post_time": None}
+monitoring_stats_lock = threading.Lock()
+# Shortest period rates are averaged over, so that a single burst of posts
+# does not report an inflated rate.
+MONITORING_STATS_MIN_SECS = 1.0
+
+# Entries are (step, message, offset, retries, timeout).
+monitoring_queue = collections.deque()
+monitoring_queue_cond = threading.Condition(monitoring_offset_lock)
+monitoring_sender = None
+monitoring_posting = False
+monitoring_dropped = 0
+
 FATAL_CALLBACK = None
 FATAL_CALLBACK_ARGS = None
 
@@ -113,58 +151,265 @@ def set_monitoring_url_retry_count(count):
   monitoring_url_retry_count = count
 
 
+def get_monitoring_flush_interval_secs():
+  return monitoring_flush_interval_secs
+
+
+def set_monitoring_flush_interval_secs(interval_secs):
+  global monitoring_flush_interval_secs
+  monitoring_flush_interval_secs = interval_secs
+
+
+def set_monitoring_gzip(enabled):
+  global monitoring_gzip
+  monitoring_gzip = enabled
+
+
+def get_monitoring_stats():
+  """
+  Returns a dict of counters of the posts to monitoring server, along with
+  posts_per_sec and bytes_per_sec averaged from the first post until now,
+  over at least MONITORING_STATS_MIN_SECS.
+  """
+  with monitoring_stats_lock:
+    stats = dict(monitoring_stats)
+  stats["posts_per_sec"] = stats["bytes_per_sec"] = 0.0
+  if stats["first_post_time"] is not None:
+    elapsed = max(time.time() - stats["first_post_time"],
+                  MONITORING_STATS_MIN_SECS)
+    stats["posts_per_sec"] = stats["posts"] / elapsed
+    stats["bytes_per_sec"] = stats["bytes_sent"] / elapsed
+  return stats
+
+
+def log_monitoring_stats():
+  """
+  Logs the counters and rates of get_monitoring_stats, if anything was
+  posted. Logged locally only, not to monitoring server.
+  """
+  stats = get_monitoring_stats()
+  if not stats["posts"] and not stats["failures"]:
+    return
+  logger.info("Monitoring: %(posts)d posts, %(failures)d failures, "
+              "%(bytes_sent)d bytes sent for %(bytes_logged)d bytes logged, "
+              "%(connections)d connections, %(reconnects)d reconnects, "
+              "%(posts_per_sec).1f posts/sec, %(bytes_per_sec).0f bytes/sec"
+              % stats)
+
+
+def close_monitoring_connections():
+  with monitoring_connections_lock:
+    connections = list(monitoring_connections.values())
+    monitoring_connections.clear()
+  for conn in connections:
+    conn.close()
+
+
 def set_log_fatal_callback(fatal_callback, arguments=()):
   # NOTE: arguments can only contain regular args and not kwargs.
   global FATAL_CALLBACK, FATAL_CALLBACK_ARGS
   FATAL_CALLBACK = fatal_callback
   FATAL_CALLBACK_ARGS = arguments
 
-def monitoring_callback(step, message=None, retries=None, timeout=None):
+def _update_monitoring_stats(**increments):
+  with monitoring_stats_lock:
+    for key, value in increments.items():
+      monitoring_stats[key] += value
+
+
+def _monitoring_request(scheme, netloc, path, body, headers, timeout):
+  """
+  Posts body on the connection kept for the server, and keeps the connection
+  for the next post unless the server closes it. A kept connection which the
+  server has closed meanwhile is replaced once.
+  Returns the response status.
   """
-  Sends a message to monitoring server if set.
+  key = (scheme, netloc)
+  while True:
+    with monitoring_connections_lock:
+      conn = monitoring_connections.pop(key, None)
+    reused = conn is not None
+    if not reused:
+      if scheme == "https":
+        conn = HTTPSConnection(netloc, timeout=timeout)
+      else:
+        conn = HTTPConnection(netloc, timeout=timeout)
+      _update_monitoring_stats(connections=1)
+    elif conn.sock:
+      conn.sock.settimeout(timeout)
+    try:
+      conn.request("POST", path, body, headers)
+      response = conn.getresponse()
+      response.read()
+    except socket.timeout:
+      conn.close()
+      raise
+    except (HTTPException, socket.error):
+      conn.close()
+      if reused:
+        _update_monitoring_stats(reconnects=1)
+        continue
+      raise
+    if not response.will_close:
+      with monitoring_connections_lock:
+        if key not in monitoring_connections:
+          monitoring_connections[key] = conn
+          conn = None
+    if conn:
+      # Closed by the server, or another post kept its connection meanwhile.
+      conn.close()
+    return response.status
+
+
+def post_monitoring_message(step, message, offset, retries=None,
+                            timeout=None):
+  """
+  Posts message, which starts at offset of the log, to monitoring server.
   Returns:
-    None if monitoring server is not set.
     True if posted successfully.
     False, otherwise.
   """
-  global monitoring_log_offset
-  if not monitoring_url_root:
-    return None
-
   retries = retries or monitoring_url_retry_count
   timeout = timeout or monitoring_url_timeout_secs
 
-  if not message:
-    message = ""
-  else:
-    message += "\n"
-
-  # Update offset under lock.
-  with monitoring_offset_lock:
-    old_offset = monitoring_log_offset
-    monitoring_log_offset += len(message)
-
   headers = {
       'Content-Type': 'application/text; charset=utf-8'
   }
 
-  url = "%s&step=%s&offset=%d" % (monitoring_url_root, quote(step), old_offset)
-  req = Request(url, message.encode(), headers)
+  url = "%s&step=%s&offset=%d" % (monitoring_url_root, quote(step), offset)
+  parts = urlsplit(url)
+  path = "%s?%s" % (parts.path or "/", parts.query)
+  body = message.encode()
+  logged = len(body)
+  if monitoring_gzip:
+    data = io.BytesIO()
+    with gzip.GzipFile(fileobj=data, mode="wb") as fp:
+      fp.write(body)
+    body = data.getvalue()
+    headers['Content-Encoding'] = 'gzip'
 
   while retries > 0:
     try:
-      result = urlopen(req, timeout=timeout)
-      if result.getcode() != 200:
+      status = _monitoring_request(parts.scheme, parts.netloc, path, body,
+                                   headers, timeout)
+      now = time.time()
+      with monitoring_stats_lock:
+        if monitoring_stats["first_post_time"] is None:
+          monitoring_stats["first_post_time"] = now
+        monitoring_stats["last_post_time"] = now
+        monitoring_stats["posts"] += 1
+        monitoring_stats["bytes_sent"] += len(body)
+        monitoring_stats["bytes_logged"] += logged
+      if status != 200:
+        _update_monitoring_stats(failures=1)
         logger.error("failed to post message to " + url)
         return False # Fatal error. No retry.
       return True # Request was successful.
-    except (URLError, socket.timeout) as e:
+    except (HTTPException, socket.error) as e:
       retries -= 1
 
+  _update_monitoring_stats(failures=1)
   logger.error("error posting message to " + url)
   return False
 
 
+def _coalesce_monitoring_entries(entries):
+  """
+  Merges consecutive entries of the same step which are contiguous in the
+  log, so that each run is posted once at the offset of its first message.
+  """
+  batches = []
+  for step, message, offset, retries, timeout in entries:
+    if batches:
+      last = batches[-1]
+      if last[0] == step and last[2] + len(last[1]) == offset:
+        batches[-1] = (step, last[1] + message, last[2], last[3], last[4])
+        continue
+    batches.append((step, message, offset, retries, timeout))
+  return batches
+
+
+def _monitoring_sender_loop():
+  global monitoring_posting
+  while True:
+    with monitoring_queue_cond:
+      while not monitoring_queue:
+        monitoring_queue_cond.wait()
+    # Let the messages logged meanwhile join this post.
+    time.sleep(monitoring_flush_interval_secs)
+    with monitoring_queue_cond:
+      entries = list(monitoring_queue)
+      monitoring_queue.clear()
+      monitoring_posting = True
+    for batch in _coalesce_monitoring_entries(entries):
+      try:
+        post_monitoring_message(*batch)
+      except Exception as e:
+        logger.error("failed to post message to monitoring server: %s" % e)
+    with monitoring_queue_cond:
+      monitoring_posting = False
+      monitoring_queue_cond.notify_all()
+
+
+def flush_monitoring(timeout=MONITORING_FLUSH_TIMEOUT_SECS):
+  """
+  Waits up to timeout seconds for the queued messages to be posted.
+  Returns True if nothing is left to post.
+  """
+  deadline = time.time() + timeout
+  with monitoring_queue_cond:
+    while monitoring_queue or monitoring_posting:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+      monitoring_queue_cond.wait(remaining)
+  return True
+
+
+def monitoring_callback(step, message=None, retries=None, timeout=None):
+  """
+  Queues a message for monitoring server if set. Never blocks on the
+  network, messages are posted by a background sender.
+  Returns:
+    None if monitoring server is not set.
+    True if queued.
+    False if dropped because the queue is full.
+  """
+  global monitoring_log_offset, monitoring_sender, monitoring_dropped
+  if not monitoring_url_root:
+    return None
+
+  if not message:
+    message = ""
+  else:
+    message += "\n"
+
+  limit = MONITORING_QUEUE_SIZE
+  if step in MONITORING_URGENT_STEPS:
+    limit += MONITORING_QUEUE_RESERVE
+
+  with monitoring_queue_cond:
+    if len(monitoring_queue) >= limit:
+      monitoring_dropped += 1
+      return False
+    dropped = monitoring_dropped
+    monitoring_dropped = 0
+    # The offset only advances for queued messages, keeping the log posted
+    # contiguous.
+    monitoring_queue.append((step, message, monitoring_log_offset, retries,
+                             timeout))
+    monitoring_log_offset += len(message)
+    if not monitoring_sender:
+      monitoring_sender = threading.Thread(target=_monitoring_sender_loop,
+                                           name="monitoring-sender")
+      monitoring_sender.daemon = True
+      monitoring_sender.start()
+    monitoring_queue_cond.notify_all()
+  if dropped:
+    logger.warning("dropped %d messages to monitoring server" % dropped)
+  return True
+
+
 def DEBUG(msg):
   monitoring_callback("debug", msg)
   logger.debug(msg)
@@ -195,13 +440,24 @@ def FATAL(msg):
   except:
     pass
   monitoring_callback("fatal", msg)
+  flush_monitoring()
   _fatal(msg)
 
+
+def _flush_monitoring_at_exit():
+  flush_monitoring()
+  log_monitoring_stats()
+
 # set a default log file on import.
 set_log_file()
+atexit.register(_flush_monitoring_at_exit)
 
 __all__ = ["INFO", "ERROR", "FATAL", "WARNING", "set_monitoring_url_root",
             "set_monitoring_url_timeout_secs", "get_monitoring_url_retry_count",
             "set_monitoring_url_retry_count", "get_monitoring_url_timeout_secs",
             "monitoring_callback", "set_log_file", "set_log_offset",
-            "set_log_fatal_callback", "DEBUG", "get_log_offset"]
+            "set_log_fatal_callback", "DEBUG", "get_log_offset",
+            "flush_monitoring", "get_monitoring_flush_interval_secs",
+            "set_monitoring_flush_interval_secs", "set_monitoring_gzip",
+            "get_monitoring_stats", "close_monitoring_connections",
+            "log_monitoring_stats"]
@@ -0,0 +1,132 @@
+#
+# Copyright (c) 2019 Nutanix Inc. All rights reserved.
+#
+# Tests of the monitoring transport of log against a local stand-in of the
+# monitoring server.
+#
+import gzip
+import io
+import threading
+import unittest
+
+try:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from urllib.parse import parse_qs, urlsplit
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from urlparse import parse_qs, urlsplit
+
+import log
+
+class MonitoringHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers["Content-Length"]))
+    if self.headers.get("Content-Encoding") == "gzip":
+      body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+    query = parse_qs(urlsplit(self.path).query)
+    self.server.posts.append({"step": query["step"][0],
+                              "offset": int(query["offset"][0]),
+                              "body": body.decode("utf-8"),
+                              "gzip": "Content-Encoding" in self.headers,
+                              "port": self.client_address[1]})
+    self.send_response(200)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+    if self.server.drop_connection:
+      # Closes the connection without telling the client.
+      self.server.drop_connection = False
+      self.close_connection = True
+
+  def log_message(self, *args):
+    pass
+
+class MonitoringTest(unittest.TestCase):
+  def setUp(self):
+    self.server = HTTPServer(("127.0.0.1", 0), MonitoringHandler)
+    self.server.posts = []
+    self.server.drop_connection = False
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    log.disable_ttyout_handler()
+    log.set_log_offset(0)
+    log.set_monitoring_flush_interval_secs(0.05)
+    log.set_monitoring_url_root("http://127.0.0.1:%d/log?session=test"
+                                % self.server.server_address[1])
+    self.stats = log.get_monitoring_stats()
+
+  def tearDown(self):
+    log.flush_monitoring()
+    log.set_monitoring_url_root(None)
+    log.set_monitoring_gzip(False)
+    log.close_monitoring_connections()
+    log.enable_ttyout_handler()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def stats_delta(self, key):
+    return log.get_monitoring_stats()[key] - self.stats[key]
+
+  def post(self, step, message):
+    self.assertTrue(log.monitoring_callback(step, message))
+    self.assertTrue(log.flush_monitoring())
+
+  def test_coalesced_offsets(self):
+    for i in range(50):
+      log.INFO("message %d" % i)
+    log.ERROR("error")
+    log.INFO("after")
+    self.assertTrue(log.flush_monitoring())
+
+    posts = self.server.posts
+    self.assertLess(len(posts), 52)
+    offset = 0
+    for post in posts:
+      self.assertEqual(post["offset"], offset)
+      offset += len(post["body"])
+    expected = "".join("message %d\n" % i for i in range(50)) + "error\nafter\n"
+    self.assertEqual("".join(post["body"] for post in posts), expected)
+    self.assertEqual([post["step"] for post in posts][-2:], ["error", "info"])
+    self.assertEqual(log.get_log_offset(), len(expected))
+
+  def test_keep_alive(self):
+    for i in range(3):
+      self.post("info", "message %d" % i)
+    self.assertEqual(len(set(post["port"] for post in self.server.posts)), 1)
+    self.assertEqual(self.stats_delta("connections"), 1)
+    self.assertEqual(self.stats_delta("posts"), 3)
+
+  def test_reconnect(self):
+    self.server.drop_connection = True
+    self.post("info", "first")
+    self.post("info", "second")
+    self.assertEqual([post["body"] for post in self.server.posts],
+                     ["first\n", "second\n"])
+    self.assertEqual(self.stats_delta("connections"), 2)
+    self.assertEqual(self.stats_delta("reconnects"), 1)
+    self.assertEqual(self.stats_delta("failures"), 0)
+
+  def test_gzip(self):
+    log.set_monitoring_gzip(True)
+    message = "compressible " * 100
+    self.post("info", message)
+    self.assertTrue(self.server.posts[0]["gzip"])
+    self.assertEqual(self.server.posts[0]["body"], message + "\n")
+    self.assertEqual(self.stats_delta("bytes_logged"), len(message) + 1)
+    self.assertLess(self.stats_delta("bytes_sent"), len(message) // 4)
+
+  def test_stats(self):
+    for i in range(3):
+      self.post("info", "message %d" % i)
+    stats = log.get_monitoring_stats()
+    self.assertEqual(self.stats_delta("bytes_sent"), 3 * len("message 0\n"))
+    # Rates are averaged over at least MONITORING_STATS_MIN_SECS, a burst
+    # does not report thousands of posts per second.
+    self.assertLessEqual(stats["posts_per_sec"],
+                         stats["posts"] / log.MONITORING_STATS_MIN_SECS)
+    self.assertGreater(stats["posts_per_sec"], 0)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,264 @@
+#
+# Copyright (c) 2019 Nutanix Inc. All rights reserved.
+#
+# This module contains functions for announcing host addresses to the
+# neighboring switches using raw ethernet frames.
+#
+import binascii
+import select
+import socket
+import struct
+import time
+
+import netUtil
+import trace_utils
+
+from log import INFO, WARNING
+
+ETH_P_ALL = 0x0003
+ETH_P_ARP = 0x0806
+ETH_P_IP = 0x0800
+
+ARP_REQUEST = 1
+ARP_REPLY = 2
+
+# From linux/socket.h, not exported by the socket module on python 2.
+SO_BINDTODEVICE = 25
+
+BROADCAST_MAC = "ff:ff:ff:ff:ff:ff"
+ZERO_MAC = "00:00:00:00:00:00"
+
+# Discard port, used as destination of the broadcast nudge.
+DISCARD_PORT = 9
+
+def mac_to_bytes(mac):
+  """
+  Returns the 6 byte binary representation of a mac address.
+  """
+  return binascii.unhexlify(mac.replace(":", ""))
+
+def get_interface_mac(intf):
+  """
+  Returns the mac address of a host interface or None.
+  """
+  try:
+    with open("/sys/class/net/%s/address" % intf) as fp:
+      return fp.read().strip()
+  except (IOError, OSError):
+    return None
+
+def build_arp_frame(op, src_mac, src_ip, target_mac, target_ip,
+                    dest_mac=BROADCAST_MAC):
+  """
+  Builds an ethernet frame carrying an ARP packet.
+
+  Args:
+    op: ARP_REQUEST or ARP_REPLY.
+    src_mac: Sender hardware address.
+    src_ip: Sender protocol address.
+    target_mac: Target hardware address.
+    target_ip: Target protocol address.
+    dest_mac: Ethernet destination address.
+
+  Returns:
+    The frame as a byte string.
+  """
+  eth_header = struct.pack("!6s6sH", mac_to_bytes(dest_mac),
+                           mac_to_bytes(src_mac), ETH_P_ARP)
+  arp_packet = struct.pack("!HHBBH6s4s6s4s", 1, ETH_P_IP, 6, 4, op,
+                           mac_to_bytes(src_mac), socket.inet_aton(src_ip),
+                           mac_to_bytes(target_mac),
+                           socket.inet_aton(target_ip))
+  return eth_header + arp_packet
+
+def build_gratuitous_arp_frames(mac, ip):
+  """
+  Returns the gratuitous ARP frames for ip, keyed by ARP operation.
+
+  The reply is equivalent to "arping -A" and the request is equivalent to
+  "arping -U". Both are broadcast so that every switch updates its tables.
+  """
+  return {
+    ARP_REPLY: build_arp_frame(ARP_REPLY, mac, ip, mac, ip),
+    ARP_REQUEST: build_arp_frame(ARP_REQUEST, mac, ip, ZERO_MAC, ip),
+  }
+
+def open_packet_socket(intf, protocol=ETH_P_ARP):
+  """
+  Opens a raw AF_PACKET socket bound to intf.
+  """
+  sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                       socket.htons(protocol))
+  sock.bind((intf, protocol))
+  return sock
+
+def parse_arp_frame(frame):
+  """
+  Parses an ethernet frame carrying an ARP packet.
+
+  Returns:
+    Tuple (op, sender_mac, sender_ip) or None if frame is not ARP.
+  """
+  if len(frame) < 42:
+    return None
+  ethertype, = struct.unpack("!H", frame[12:14])
+  if ethertype != ETH_P_ARP:
+    return None
+  op, sha, spa = struct.unpack("!H6s4s", frame[20:32])
+  mac = ":".join("%02x" % b for b in bytearray(sha))
+  return op, mac, socket.inet_ntoa(spa)
+
+def probe_arp(intfs, target_ip, src_ip="0.0.0.0", timeout=3, attempts=3):
+  """
+  Tests reachability of target_ip through each of intfs concurrently.
+
+  An ARP request is sent out of every interface directly, bypassing any
+  bridge or bond the interface is part of, and the replies are collected on
+  per-interface packet sockets. Requests are retransmitted on interfaces
+  which have not received a reply yet.
+
+  Args:
+    intfs: List of interface names.
+    target_ip: Address to resolve.
+    src_ip: Sender address used in the requests. Defaults to an ARP probe.
+    timeout: Total time in seconds to wait for replies.
+    attempts: Number of requests sent on each interface.
+
+  Returns:
+    Dict mapping each interface which received a reply to the time in
+    seconds since the latest request sent on it.
+  """
+  sockets = {}
+  requests = {}
+  for intf in intfs:
+    mac = get_interface_mac(intf)
+    if not mac:
+      WARNING("Unable to find mac address of %s, not probing it" % intf)
+      continue
+    try:
+      # ETH_P_ALL is needed to see frames consumed by an OVS bridge.
+      sockets[intf] = open_packet_socket(intf, protocol=ETH_P_ALL)
+    except socket.error as e:
+      WARNING("Unable to open packet socket on %s: %s" % (intf, e))
+      continue
+    requests[intf] = build_arp_frame(ARP_REQUEST, mac, src_ip, ZERO_MAC,
+                                     target_ip)
+
+  by_fd = dict((sock.fileno(), intf) for intf, sock in sockets.items())
+  sent_at = {}
+  results = {}
+  try:
+    start = time.time()
+    deadline = start + timeout
+    retransmit_interval = float(timeout) / max(attempts, 1)
+    next_send = start
+    sent = 0
+    while len(results) < len(sockets):
+      now = time.time()
+      if now >= deadline:
+        break
+      if sent < attempts and now >= next_send:
+        for intf, sock in sockets.items():
+          if intf in results:
+            continue
+          try:
+            sock.send(requests[intf])
+            # Time from the latest request, an interface which only
+            # answers a retransmit is not ranked as slow.
+            sent_at[intf] = now
+          except socket.error as e:
+            WARNING("Failed to send ARP probe on %s: %s" % (intf, e))
+        sent += 1
+        next_send = now + retransmit_interval
+      wait = min(deadline, next_send if sent < attempts else deadline) - now
+      readable, _, _ = select.select(list(sockets.values()), [], [],
+                                     max(wait, 0))
+      for sock in readable:
+        intf = by_fd[sock.fileno()]
+        try:
+          frame = sock.recv(2048)
+        except socket.error:
+          continue
+        arp = parse_arp_frame(frame)
+        if (arp and arp[0] == ARP_REPLY and arp[2] == target_ip and
+            intf not in results and intf in sent_at):
+          results[intf] = time.time() - sent_at[intf]
+  finally:
+    for sock in sockets.values():
+      sock.close()
+  return results
+
+def send_broadcast_nudge(intf, ip, netmask):
+  """
+  Sends a single UDP datagram to the broadcast address of the subnet of intf.
+  This replaces the broadcast ping which seems to help with broken switches.
+  No reply is expected.
+  """
+  broadcast_ip = netUtil.get_broadcast_address(ip, netmask)
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, intf.encode() + b"\0")
+    sock.sendto(b"", (broadcast_ip, DISCARD_PORT))
+  finally:
+    sock.close()
+
+def announce_addresses(addresses, count=1, interval=2):
+  """
+  Sends gratuitous ARP frames for all the given addresses at once.
+
+  Every round sends an ARP reply followed, interval seconds later, by an ARP
+  request on all interfaces. Interfaces are handled together so the total
+  time is independent of the number of interfaces.
+
+  Args:
+    addresses: List of (interface, ip, netmask) tuples. netmask may be None.
+    count: Number of rounds.
+    interval: Seconds between consecutive frames on an interface.
+
+  Returns:
+    List of interfaces for which all frames were sent.
+  """
+  sockets = {}
+  frames = {}
+  for intf, ip, netmask in addresses:
+    mac = get_interface_mac(intf)
+    if not mac:
+      WARNING("Unable to find mac address of %s, skipping ARP update" % intf)
+      continue
+    try:
+      sockets[intf] = open_packet_socket(intf)
+    except socket.error as e:
+      WARNING("Unable to open packet socket on %s: %s" % (intf, e))
+      continue
+    frames[intf] = build_gratuitous_arp_frames(mac, ip)
+
+  failed = set()
+  try:
+    ops = [ARP_REPLY, ARP_REQUEST] * count
+    for i, op in enumerate(ops):
+      if i:
+        trace_utils.sleep(interval, "arp_interval")
+      for intf, sock in sockets.items():
+        try:
+          sock.send(frames[intf][op])
+        except socket.error as e:
+          WARNING("Failed to send gratuitous ARP on %s: %s" % (intf, e))
+          failed.add(intf)
+  finally:
+    for sock in sockets.values():
+      sock.close()
+
+  # Broadcast nudge. Seems to help with broken switches.
+  for intf, ip, netmask in addresses:
+    if intf not in sockets or not netmask:
+      continue
+    try:
+      send_broadcast_nudge(intf, ip, netmask)
+    except socket.error as e:
+      WARNING("Failed to send broadcast on %s: %s" % (intf, e))
+
+  announced = [intf for intf in sockets if intf not in failed]
+  if announced:
+    INFO("Sent gratuitous ARP on %s" % ", ".join(sorted(announced)))
+  return announced
@@ -6,45 +6,255 @@
 # This module contains functions for configuring networks.
 #
 import os
+import socket
+import struct
+import tempfile
+
+IFCFG_DIR = "/etc/sysconfig/network-scripts"
+IFCFG_PREFIX = "ifcfg-"
+
+def get_vswitch_mtus(vswitches):
+  """
+  Returns a dict mapping vswitch name to its MTU, or None if MTU is not set.
+  """
+  return dict((vs["name"], vs.get("mtu")) for vs in vswitches or [])
+
+def generate_ifcfg(iface, vswitch_mtus, is_ovs=False):
+  """
+  Given JSON dict iface and the MTU of each vswitch, generate ifcfg content.
+
+  iface: dict representing either a CVM or host interface.
+  vswitch_mtus: dict as returned by get_vswitch_mtus.
+  """
+  lines = ["# Auto generated by phoenix\n"
+           "DEVICE=%(name)s\n"
+           "NM_CONTROLLED=no\n"
+           "ONBOOT=yes\n" % iface]
+
+  if is_ovs:
+    lines.append("TYPE=OVSIntPort\n"
+                 "DEVICETYPE=ovs\n")
+  else:
+    lines.append("TYPE=Ethernet\n")
+
+  if iface.get("ip") == "dhcp":
+    lines.append("BOOTPROTO=dhcp\n")
+  else:
+    lines.append("BOOTPROTO=none\n")
+    if iface.get("ip"):
+      lines.append("IPADDR=%(ip)s\n"
+                   "NETMASK=%(netmask)s\n" % iface)
+      if iface.get("gateway"):
+        lines.append("GATEWAY=%(gateway)s\n" % iface)
+
+  mtu = vswitch_mtus.get(iface["vswitch"])
+  if mtu is not None:
+    lines.append("MTU=%d\n" % mtu)
+  return "".join(lines)
+
+def parse_ifcfg(content):
+  """
+  Returns a dict of the KEY=VALUE settings in ifcfg content.
+  """
+  config = {}
+  for line in content.strip().splitlines():
+    if line.startswith("#"):
+      continue
+    try:
+      key, value = line.strip().split("=", 1)
+      config[key] = value
+    except ValueError:
+      pass
+  return config
+
+def ifcfg_contains(content, expected):
+  """
+  Returns True if every setting of ifcfg content expected is present with the
+  same value in ifcfg content. Additional settings are ignored.
+  """
+  config = parse_ifcfg(content)
+  return all(config.get(key) == value
+             for key, value in parse_ifcfg(expected).items())
+
+def write_file_atomic(path, content, mode=0o644):
+  """
+  Writes content to path through a temporary file in the same directory
+  followed by a rename, so readers see either the old or the new file.
+  The mode of an existing file is preserved.
+  """
+  try:
+    mode = os.stat(path).st_mode & 0o7777
+  except OSError:
+    pass
+  fd, temp_path = tempfile.mkstemp(prefix=".%s." % os.path.basename(path),
+                                   dir=os.path.dirname(path) or ".")
+  try:
+    with os.fdopen(fd, "w") as fp:
+      fp.write(content)
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.chmod(temp_path, mode)
+    os.rename(temp_path, path)
+  except:
+    if os.path.exists(temp_path):
+      os.unlink(temp_path)
+    raise
 
 def write_ifcfg(iface, vswitches, path_prefix=".", is_ovs=False):
   """
   Given JSON dicts iface and list of switch configurations, generate ifcfg file.
+  The file is replaced atomically and only if its content changes.
 
   iface: dict representing either a CVM or host interface.
-  vswitches: list of vswitches
-  """
-  with open(path_prefix + "/etc/sysconfig/network-scripts/ifcfg-" +
-            iface["name"], "w") as outfile:
-    outfile.write("# Auto generated by phoenix\n"
-                  "DEVICE=%(name)s\n"
-                  "NM_CONTROLLED=no\n"
-                  "ONBOOT=yes\n" % iface)
-
-    if is_ovs:
-      outfile.write("TYPE=OVSIntPort\n"
-                    "DEVICETYPE=ovs\n")
-    else:
-      outfile.write("TYPE=Ethernet\n")
-
-    if iface.get("ip") == "dhcp":
-      outfile.write("BOOTPROTO=dhcp\n")
-    else:
-      outfile.write("BOOTPROTO=none\n")
-      if iface.get("ip"):
-        outfile.write("IPADDR=%(ip)s\n"
-                      "NETMASK=%(netmask)s\n" % iface)
-        if iface.get("gateway"):
-          outfile.write("GATEWAY=%(gateway)s\n" % iface)
-
-    # Lookup MTU in vswitches.
-    mtu = None
-    for vs in vswitches:
-      if vs["name"] == iface["vswitch"]:
-        mtu = vs.get("mtu")
-        break
-    if mtu is not None:
-      outfile.write("MTU=%d\n" % mtu)
+  vswitches: list of vswitches, or dict as returned by get_vswitch_mtus.
+
+  Returns True if the file was written, False if it was already up to date.
+  """
+  if not isinstance(vswitches, dict):
+    vswitches = get_vswitch_mtus(vswitches)
+  store = IfcfgStore(path_prefix=path_prefix, load=False)
+  store.set_iface(iface, vswitches, is_ovs=is_ovs)
+  return bool(store.commit())
+
+class IfcfgStore(object):
+  """
+  In-memory model of the ifcfg files in network-scripts.
+
+  All files are read in a single pass. Changes are staged in memory and
+  commit() writes only the files whose content differs from what is on disk,
+  each one atomically.
+  """
+  def __init__(self, path_prefix="", load=True):
+    self.directory = path_prefix + IFCFG_DIR
+    # Content on disk, keyed by interface name.
+    self._disk = {}
+    # Staged content, keyed by interface name. None means removed.
+    self._staged = {}
+    if load:
+      self.load()
+
+  def load(self):
+    """
+    Reads all ifcfg files, discarding staged changes.
+    """
+    self._disk = {}
+    self._staged = {}
+    if not os.path.isdir(self.directory):
+      return
+    for file_name in os.listdir(self.directory):
+      if not file_name.startswith(IFCFG_PREFIX):
+        continue
+      path = os.path.join(self.directory, file_name)
+      if not os.path.isfile(path):
+        continue
+      with open(path) as fp:
+        self._disk[file_name[len(IFCFG_PREFIX):]] = fp.read()
+
+  def _path(self, name):
+    return os.path.join(self.directory, IFCFG_PREFIX + name)
+
+  def _read(self, name):
+    # Files are loaded lazily when the store was created with load=False.
+    if name not in self._disk:
+      try:
+        with open(self._path(name)) as fp:
+          self._disk[name] = fp.read()
+      except (IOError, OSError):
+        self._disk[name] = None
+    return self._disk[name]
+
+  def names(self):
+    """
+    Returns the names of interfaces which have an ifcfg file.
+    """
+    names = set(name for name, content in self._disk.items() if content)
+    for name, content in self._staged.items():
+      if content is None:
+        names.discard(name)
+      else:
+        names.add(name)
+    return sorted(names)
+
+  def get_content(self, name):
+    """
+    Returns the content of ifcfg file of interface name or None.
+    """
+    if name in self._staged:
+      return self._staged[name]
+    return self._read(name)
+
+  def get_config(self, name):
+    """
+    Returns the settings of interface name as a dict.
+    """
+    return parse_ifcfg(self.get_content(name) or "")
+
+  def set_content(self, name, content):
+    self._staged[name] = content
+
+  def set_iface(self, iface, vswitch_mtus, is_ovs=False):
+    """
+    Stages a generated ifcfg file for JSON dict iface.
+    """
+    self.set_content(iface["name"],
+                     generate_ifcfg(iface, vswitch_mtus, is_ovs=is_ovs))
+
+  def set(self, name, key, value):
+    """
+    Sets KEY=VALUE in ifcfg file of interface name, replacing any previous
+    settings of key.
+    """
+    lines = []
+    replaced = False
+    for line in (self.get_content(name) or "").splitlines():
+      if line.split("=", 1)[0].strip() == key:
+        if replaced:
+          continue
+        line = "%s=%s" % (key, value)
+        replaced = True
+      lines.append(line)
+    if not replaced:
+      lines.append("%s=%s" % (key, value))
+    self.set_content(name, "\n".join(lines) + "\n")
+
+  def remove(self, name):
+    self._staged[name] = None
+
+  def changed(self):
+    """
+    Returns names of interfaces whose staged content differs from disk.
+    """
+    return sorted(name for name, content in self._staged.items()
+                  if content != self._read(name))
+
+  def commit(self, names=None):
+    """
+    Writes staged changes to disk.
+
+    Args:
+      names: Interfaces to commit. All staged interfaces if None.
+
+    Returns:
+      Sorted list of interfaces whose ifcfg file was written or removed.
+    """
+    changed = []
+    for name in self.changed():
+      if names is not None and name not in names:
+        continue
+      content = self._staged.pop(name)
+      if content is None:
+        if os.path.exists(self._path(name)):
+          os.unlink(self._path(name))
+      else:
+        write_file_atomic(self._path(name), content)
+      self._disk[name] = content
+      changed.append(name)
+    # Drop staged entries which matched the disk.
+    for name in list(self._staged):
+      if ((names is None or name in names) and
+          self._staged[name] == self._read(name)):
+        del self._staged[name]
+    return changed
 
 def get_mac_addr(netdev):
   """
@@ -80,3 +290,54 @@ def get_netdev_from_bus_addr(bus_addr):
     if bus_addr in path:
       return netdev
   return None
+
+def ip_to_int(address):
+  """
+  Returns the integer value of a dotted quad IPv4 address.
+  """
+  return struct.unpack("!I", socket.inet_aton(address))[0]
+
+def int_to_ip(value):
+  """
+  Returns the dotted quad representation of an integer IPv4 address.
+  """
+  return socket.inet_ntoa(struct.pack("!I", value & 0xFFFFFFFF))
+
+def get_network_address(ip, netmask):
+  """
+  Returns the network address of ip in the subnet described by netmask.
+  """
+  return int_to_ip(ip_to_int(ip) & ip_to_int(netmask))
+
+def get_broadcast_address(ip, netmask):
+  """
+  Returns the broadcast address of ip in the subnet described by netmask.
+  """
+  mask = ip_to_int(netmask)
+  return int_to_ip((ip_to_int(ip) & mask) | (~mask & 0xFFFFFFFF))
+
+def is_valid_netmask(netmask):
+  """
+  Returns True if netmask is a dotted quad with contiguous leading one bits.
+  """
+  try:
+    mask = struct.unpack("!I", socket.inet_pton(socket.AF_INET, netmask))[0]
+  except (socket.error, TypeError, ValueError):
+    return False
+  inverted = ~mask & 0xFFFFFFFF
+  return mask != 0 and inverted & (inverted + 1) == 0
+
+def get_tcp_connect_error(ip, port, timeout=5):
+  """
+  Returns None if a TCP connection to ip:port can be established within
+  timeout seconds, the socket error otherwise.
+  """
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.settimeout(timeout)
+  try:
+    sock.connect((ip, port))
+  except (socket.error, socket.timeout) as e:
+    return e
+  finally:
+    sock.close()
+  return None
@@ -0,0 +1,192 @@
+#
+# Copyright (c) 2019 Nutanix Inc. All rights reserved.
+#
+# This module contains the pre-flight checks run on a network configuration
+# before anything on the host is changed. The checks only read the config
+# and the live state of the host, and report every problem found instead of
+# stopping at the first one.
+#
+import kvm_net_utils
+import netUtil
+
+from log import ERROR, INFO, WARNING
+
+# MTUs supported on the vswitches.
+MIN_MTU = 1500
+MAX_MTU = 9000
+
+CVM_INTERNAL_IP = "192.168.5.254"
+CVM_SSH_PORT = 22
+CVM_CONNECT_TIMEOUT_SECS = 5
+
+INTERNAL_VSWITCH = "_internal_"
+
+def get_configured_interfaces(cfg):
+  """
+  Returns (owner, interface) tuples for all external interfaces of cfg,
+  where owner is "host" or "cvm".
+  """
+  interfaces = []
+  for owner, key in (("host", "host_interfaces"), ("cvm", "cvm_interfaces")):
+    for iface in cfg.get(key, []):
+      if iface.get("vswitch") != INTERNAL_VSWITCH:
+        interfaces.append((owner, iface))
+  return interfaces
+
+def get_static_interfaces(cfg):
+  """
+  Returns the (owner, interface) tuples of get_configured_interfaces which
+  have a static address, leaving out the dhcp ones.
+  """
+  return [(owner, iface) for owner, iface in get_configured_interfaces(cfg)
+          if iface["ip"] != "dhcp"]
+
+def get_vswitches(cfg):
+  """
+  Returns the vswitches of cfg, with the default br0 configure_ovs creates
+  if there are none.
+  """
+  return cfg.get("vswitches") or [{"name": "br0", "uplinks": [],
+                                   "mtu": MIN_MTU}]
+
+def check_subnets(cfg):
+  """
+  Checks that every interface address is a host address of its subnet, that
+  its gateway is in the same subnet, and that interfaces on the same vswitch
+  and vlan share a subnet. Interfaces configured with dhcp are not checked.
+  """
+  errors = []
+  subnets = {}
+  for owner, iface in get_static_interfaces(cfg):
+    label = "%s interface %s" % (owner, iface["name"])
+    ip, netmask, gateway = iface["ip"], iface["netmask"], iface["gateway"]
+    network = netUtil.get_network_address(ip, netmask)
+    broadcast = netUtil.get_broadcast_address(ip, netmask)
+    if netmask != "255.255.255.255" and ip in (network, broadcast):
+      errors.append("%s: %s is not a host address of %s/%s"
+                    % (label, ip, network, netmask))
+    if netUtil.get_network_address(gateway, netmask) != network:
+      errors.append("%s: gateway %s is not in subnet %s/%s"
+                    % (label, gateway, network, netmask))
+    elif gateway in (network, broadcast):
+      errors.append("%s: gateway %s is not a host address of %s/%s"
+                    % (label, gateway, network, netmask))
+
+    segment = (iface["vswitch"], str(iface.get("vlan") or 0))
+    subnet = (network, netmask, gateway)
+    if segment not in subnets:
+      subnets[segment] = (label, subnet)
+    elif subnets[segment][1] != subnet:
+      errors.append("%s: %s/%s via %s differs from %s on the same vswitch "
+                    "%s and vlan %s" % ((label,) + subnet +
+                                        (subnets[segment][0],) + segment))
+  return errors
+
+def check_duplicate_ips(cfg):
+  """
+  Checks that no address is used by two interfaces, or by an interface and a
+  gateway. Interfaces configured with dhcp are not checked.
+  """
+  errors = []
+  owners = {}
+  gateways = set()
+  for owner, iface in get_static_interfaces(cfg):
+    label = "%s interface %s" % (owner, iface["name"])
+    if iface["ip"] in owners:
+      errors.append("%s: %s is already used by %s"
+                    % (label, iface["ip"], owners[iface["ip"]]))
+    else:
+      owners[iface["ip"]] = label
+    gateways.add(iface["gateway"])
+  for gateway in sorted(gateways):
+    if gateway in owners:
+      errors.append("Gateway %s is also the address of %s"
+                    % (gateway, owners[gateway]))
+  return errors
+
+def check_vswitches(cfg):
+  """
+  Checks vswitch MTUs and that interfaces only refer to configured vswitches.
+  """
+  errors = []
+  names = set()
+  for vs in get_vswitches(cfg):
+    names.add(vs["name"])
+    if not MIN_MTU <= int(vs["mtu"]) <= MAX_MTU:
+      errors.append("vswitch %s: MTU %s is not in range %s-%s"
+                    % (vs["name"], vs["mtu"], MIN_MTU, MAX_MTU))
+  for owner, iface in get_configured_interfaces(cfg):
+    if iface["vswitch"] not in names:
+      errors.append("%s interface %s: vswitch %s is not configured"
+                    % (owner, iface["name"], iface["vswitch"]))
+  return errors
+
+def check_uplinks(cfg, nics):
+  """
+  Resolves the uplinks of every vswitch against nics the same way
+  configure_ovs does, and checks that every vswitch gets at least one.
+
+  Args:
+    cfg: Network configuration json.
+    nics: Nics as returned by kvm_net_utils.get_netdevs.
+  """
+  errors = []
+  nics = [nic for nic in nics if nic[2] != "cdc_ether"]
+  nics = sorted(nics, key=lambda nic: nic[4], reverse=True)
+  vswitches = get_vswitches(cfg)
+  if len(vswitches) == 1 and not vswitches[0].get("uplinks"):
+    # configure_ovs gives all nics to a single vswitch without uplinks.
+    if not nics:
+      errors.append("vswitch %s: no nic available" % vswitches[0]["name"])
+    return errors
+
+  for vs in vswitches:
+    uplink_devs, remaining_nics = kvm_net_utils.get_vswitch_links(
+        {"uplinks": vs.get("uplinks", [])}, nics)
+    if not uplink_devs:
+      errors.append("vswitch %s: none of the uplinks %s exists"
+                    % (vs["name"], ", ".join(vs.get("uplinks", [])) or
+                       "(default)"))
+      continue
+    speeds = [int(speed) for speed in vs.get("uplink_speeds", [])]
+    if speeds and not any(kvm_net_utils.nic_supports_speeds(dev, speeds)
+                          for dev in uplink_devs):
+      # configure_ovs falls back to the fastest nic in this case.
+      WARNING("vswitch %s: no uplink supports speeds %s"
+              % (vs["name"], speeds))
+    nics = remaining_nics
+  return errors
+
+def check_cvm_reachable(ip=CVM_INTERNAL_IP, port=CVM_SSH_PORT,
+                        timeout=CVM_CONNECT_TIMEOUT_SECS):
+  """
+  Checks that the ssh port of the CVM accepts connections.
+  """
+  error = netUtil.get_tcp_connect_error(ip, port, timeout)
+  if error:
+    return ["CVM is not reachable on %s:%s: %s" % (ip, port, error)]
+  return []
+
+def run_preflight(cfg, nics=None, check_cvm=True):
+  """
+  Runs all pre-flight checks on cfg, which must have passed
+  validate_parameters.
+
+  Args:
+    cfg: Network configuration json.
+    nics: Nics as returned by kvm_net_utils.get_netdevs, read if None.
+    check_cvm: Check that the CVM can be reached.
+
+  Returns:
+    List of problems found, empty if cfg can be applied.
+  """
+  INFO("Running pre-flight checks")
+  if nics is None:
+    nics = kvm_net_utils.get_netdevs()
+  errors = (check_vswitches(cfg) + check_subnets(cfg) +
+            check_duplicate_ips(cfg) + check_uplinks(cfg, nics))
+  if check_cvm:
+    errors += check_cvm_reachable()
+  for error in errors:
+    ERROR("Pre-flight check failed: %s" % error)
+  return errors
@@ -0,0 +1,83 @@
+#
+# Copyright (c) 2019 Nutanix Inc. All rights reserved.
+#
+# Offline tests of the config validation of network_configuration and of
+# the pre-flight checks which only read the config.
+#
+import copy
+import imp
+import os
+import unittest
+
+import preflight_utils
+
+network_configuration = imp.load_source(
+    "network_configuration",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 "network_configuration"))
+
+CONFIG = {
+  "vswitches": [{"name": "br0", "uplinks": [], "mtu": 1500}],
+  "host_interfaces": [
+    {"name": "br0", "vswitch": "br0", "vlan": "0", "ip": "10.0.0.5",
+     "netmask": "255.255.255.0", "gateway": "10.0.0.1"}],
+  "cvm_interfaces": [
+    {"name": "eth0", "vswitch": "br0", "vlan": "0", "ip": "10.0.0.6",
+     "netmask": "255.255.255.0", "gateway": "10.0.0.1"},
+    {"name": "eth1", "vswitch": "_internal_", "vlan": "0",
+     "ip": "192.168.5.254", "netmask": "255.255.255.0",
+     "gateway": "192.168.5.1"}],
+}
+
+def make_config(**cvm_eth0):
+  cfg = copy.deepcopy(CONFIG)
+  cfg["cvm_interfaces"][0].update(cvm_eth0)
+  return cfg
+
+class ValidateParametersTest(unittest.TestCase):
+  def test_static(self):
+    self.assertTrue(network_configuration.validate_parameters(make_config()))
+
+  def test_invalid_ip(self):
+    self.assertFalse(network_configuration.validate_parameters(
+        make_config(ip="10.0.0.256")))
+
+  def test_invalid_netmask(self):
+    self.assertFalse(network_configuration.validate_parameters(
+        make_config(netmask="255.0.255.0")))
+
+  def test_dhcp(self):
+    self.assertTrue(network_configuration.validate_parameters(
+        make_config(ip="dhcp", netmask="dhcp", gateway="dhcp")))
+
+  def test_dhcp_still_needs_all_keys(self):
+    self.assertFalse(network_configuration.validate_parameters(
+        make_config(ip="dhcp", gateway="")))
+
+class PreflightTest(unittest.TestCase):
+  def test_static(self):
+    cfg = make_config()
+    self.assertEqual(preflight_utils.check_subnets(cfg), [])
+    self.assertEqual(preflight_utils.check_duplicate_ips(cfg), [])
+    self.assertEqual(preflight_utils.check_vswitches(cfg), [])
+
+  def test_subnet_mismatch(self):
+    errors = preflight_utils.check_subnets(make_config(gateway="10.0.1.1"))
+    self.assertTrue(any("gateway 10.0.1.1 is not in subnet" in error
+                        for error in errors))
+
+  def test_duplicate_ip(self):
+    errors = preflight_utils.check_duplicate_ips(make_config(ip="10.0.0.5"))
+    self.assertEqual(len(errors), 1)
+    self.assertIn("10.0.0.5 is already used by host interface br0", errors[0])
+
+  def test_dhcp(self):
+    cfg = make_config(ip="dhcp", netmask="dhcp", gateway="dhcp")
+    cfg["host_interfaces"][0].update(ip="dhcp", netmask="dhcp",
+                                     gateway="dhcp")
+    self.assertEqual(preflight_utils.check_subnets(cfg), [])
+    self.assertEqual(preflight_utils.check_duplicate_ips(cfg), [])
+    self.assertEqual(preflight_utils.check_vswitches(cfg), [])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,147 @@
+#
+# Copyright (c) 2019 Nutanix Inc. All rights reserved.
+#
+# This module tracks when the CVM becomes ready after its network or genesis
+# has been restarted, by polling cheap signals with backoff instead of
+# sleeping for a fixed time.
+#
+import re
+import time
+
+import netUtil
+import trace_utils
+
+from firstboot_utils import run_cmd_on_svm
+from log import INFO, WARNING
+
+CVM_INTERNAL_IP = "192.168.5.254"
+CVM_SSH_HOST = "nutanix@%s" % CVM_INTERNAL_IP
+CVM_SSH_PORT = 22
+
+GENESIS_PATH = "/home/nutanix/cluster/bin/genesis"
+
+# Polling starts at INITIAL_POLL_SECS and backs off up to MAX_POLL_SECS.
+INITIAL_POLL_SECS = 0.5
+MAX_POLL_SECS = 5
+POLL_BACKOFF = 2
+
+CVM_NETWORK_TIMEOUT_SECS = 300
+GENESIS_TIMEOUT_SECS = 120
+
+class CvmReadinessTracker(object):
+  """
+  Waits for the CVM to reach a state and records how long it took.
+
+  Args:
+    cfg: Network configuration json, its external cvm interfaces are the
+        addresses expected inside the CVM.
+  """
+  def __init__(self, cfg):
+    self.cfg = cfg
+    # Seconds it took to get ready, keyed by what was waited for.
+    self.timings = {}
+
+  def ssh_port_open(self):
+    return netUtil.get_tcp_connect_error(CVM_INTERNAL_IP, CVM_SSH_PORT,
+                                         timeout=2) is None
+
+  def _run(self, cmd):
+    # Polled, so a single attempt without retries.
+    return run_cmd_on_svm(cmd, dest_host=CVM_SSH_HOST, attempts=1,
+                          retry_wait=0, fatal=False, timeout=30, quiet=True)
+
+  def addresses_configured(self):
+    """
+    Returns True if the external cvm interfaces have their configured
+    addresses.
+    """
+    out, _, ret = self._run("ip -4 -o addr show")
+    if ret:
+      return False
+    return all(" inet %s/" % iface["ip"] in out
+               for iface in self.cfg["cvm_interfaces"]
+               if iface["vswitch"] != "_internal_" and iface["ip"] != "dhcp")
+
+  def routes_configured(self):
+    """
+    Returns True if the external cvm interfaces have their subnet routes and,
+    if gateways are configured, the default route goes through one of them.
+    """
+    out, _, ret = self._run("ip -4 route show")
+    if ret:
+      return False
+    routes = [line.split() for line in out.splitlines()]
+    sources = set(route[i + 1] for route in routes
+                  for i in range(len(route) - 1) if route[i] == "src")
+    default_gateways = set(route[2] for route in routes
+                           if route[:2] == ["default", "via"] and
+                           len(route) > 2)
+    external = [iface for iface in self.cfg["cvm_interfaces"]
+                if iface["vswitch"] != "_internal_" and iface["ip"] != "dhcp"]
+    gateways = [iface["gateway"] for iface in external if iface["gateway"]]
+    if gateways and not default_gateways.intersection(gateways):
+      return False
+    return all(iface["ip"] in sources for iface in external)
+
+  def network_configured(self):
+    """
+    Returns True if the CVM is reachable with its addresses and routes.
+    """
+    return (self.ssh_port_open() and self.addresses_configured() and
+            self.routes_configured())
+
+  def genesis_running(self):
+    out, _, ret = self._run("%s status" % GENESIS_PATH)
+    return not ret and re.search(r"genesis: \[\d", out) is not None
+
+  def wait_for(self, name, checks, timeout):
+    """
+    Polls checks in order, with backoff, until all of them pass or timeout
+    seconds have passed. A check is not polled again once it has passed.
+
+    Args:
+      name: What is waited for, the key of the time recorded in timings.
+      checks: List of callables returning True when their condition holds.
+      timeout: Seconds to wait.
+
+    Returns:
+      True if all checks passed, False on timeout.
+    """
+    start = time.time()
+    interval = INITIAL_POLL_SECS
+    pending = list(checks)
+    with trace_utils.span("wait for %s" % name):
+      while True:
+        while pending and pending[0]():
+          pending.pop(0)
+        elapsed = time.time() - start
+        if not pending:
+          self.timings[name] = elapsed
+          INFO("%s ready after %.1f seconds" % (name, elapsed))
+          return True
+        if elapsed >= timeout:
+          WARNING("%s not ready after %.0f seconds, waiting for %s"
+                  % (name, elapsed, pending[0].__name__))
+          return False
+        trace_utils.sleep(min(interval, timeout - elapsed),
+                          "poll %s" % pending[0].__name__)
+        interval = min(interval * POLL_BACKOFF, MAX_POLL_SECS)
+
+  def wait_for_network(self, timeout=CVM_NETWORK_TIMEOUT_SECS):
+    """
+    Waits until the CVM accepts ssh connections and has its addresses and
+    routes.
+    """
+    return self.wait_for("CVM network", [self.ssh_port_open,
+                                         self.addresses_configured,
+                                         self.routes_configured], timeout)
+
+  def wait_for_genesis(self, timeout=GENESIS_TIMEOUT_SECS):
+    """
+    Waits until genesis runs.
+    """
+    return self.wait_for("genesis", [self.genesis_running], timeout)
+
+  def report(self):
+    for name, elapsed in sorted(self.timings.items()):
+      INFO("Time to ready for %s: %.1f seconds" % (name, elapsed))
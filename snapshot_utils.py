@@ -0,0 +1,326 @@
+#
+# Copyright (c) 2019 Nutanix Inc. All rights reserved.
+#
+# This module captures the network state of the host and the CVM before a
+# configuration run changes it, and rolls the node back to that state if the
+# run fails.
+#
+# Each subsystem is captured in one pass and restored in one batched
+# operation: a single ovs-vsctl transaction for the vswitches, one commit of
+# the host ifcfg files, one defineXML for the CVM domain and one ssh call for
+# the CVM ifcfg files.
+#
+import base64
+import io
+import json
+import pipes
+import tarfile
+import threading
+
+import kvm_net_utils
+import libvirt_utils
+import netUtil
+
+from firstboot_utils import run_cmd_new, run_cmd_on_svm
+from log import ERROR, INFO
+
+CVM_SSH_HOST = "nutanix@192.168.5.254"
+
+# Columns needed to rebuild the vswitches, by OVS table.
+OVS_COLUMNS = [
+  ("Bridge", ["name", "ports"]),
+  ("Port", ["_uuid", "name", "interfaces", "tag", "trunks", "vlan_mode",
+            "bond_mode", "lacp", "other_config"]),
+  ("Interface", ["_uuid", "name", "type", "options", "external_ids"]),
+]
+
+def _ovs_atoms(value):
+  """
+  Returns the atoms of an OVS json value, which is a set, a map, a uuid or
+  a bare atom.
+  """
+  if isinstance(value, list) and value and value[0] == "set":
+    return [_ovs_atoms(atom)[0] for atom in value[1]]
+  if isinstance(value, list) and value and value[0] == "uuid":
+    return [value[1]]
+  return [value]
+
+def _ovs_string(value):
+  """
+  Returns value, a string, an integer or a list of integers, in the syntax of
+  the ovs-vsctl command line, quoted for the shell.
+  """
+  if isinstance(value, list):
+    return ",".join("%d" % atom for atom in value)
+  if isinstance(value, int):
+    return "%d" % value
+  value = '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+  return pipes.quote(value)
+
+def parse_ovs_tables(out):
+  """
+  Parses the output of ovs-vsctl --format=json --data=json with one list
+  command per table of OVS_COLUMNS.
+
+  Returns:
+    Dict mapping table name to a list of rows, each a dict keyed by column.
+  """
+  decoder = json.JSONDecoder()
+  tables = {}
+  pos = 0
+  for table, _ in OVS_COLUMNS:
+    while out[pos:pos + 1].isspace():
+      pos += 1
+    doc, pos = decoder.raw_decode(out, pos)
+    tables[table] = [dict(zip(doc["headings"], row)) for row in doc["data"]]
+  return tables
+
+def capture_ovs():
+  """
+  Captures the Nutanix vswitches with their ports and interfaces in a single
+  ovs-vsctl call.
+
+  Returns:
+    List of bridge dicts with keys name and ports. Every port is a dict with
+    keys name, interfaces and settings, every interface a dict with keys
+    name and settings. Settings are (column, value) tuples.
+  """
+  cmd = ["ovs-vsctl", "--format=json", "--data=json"]
+  for table, columns in OVS_COLUMNS:
+    cmd += ["--", "--columns=%s" % ",".join(columns), "list", table]
+  out, _, _ = run_cmd_new(cmd, quiet=True)
+  tables = parse_ovs_tables(out)
+
+  interfaces = {}
+  for row in tables["Interface"]:
+    settings = []
+    if row["type"]:
+      settings.append(("type", row["type"]))
+    for column in ("options", "external_ids"):
+      for key, value in row[column][1]:
+        settings.append(("%s:%s" % (column, key), value))
+    interfaces[_ovs_atoms(row["_uuid"])[0]] = {"name": row["name"],
+                                               "settings": settings}
+  ports = {}
+  for row in tables["Port"]:
+    settings = []
+    for column in ("tag", "vlan_mode", "bond_mode", "lacp"):
+      atoms = _ovs_atoms(row[column])
+      if atoms:
+        settings.append((column, atoms[0]))
+    trunks = _ovs_atoms(row["trunks"])
+    if trunks:
+      settings.append(("trunks", trunks))
+    for key, value in row["other_config"][1]:
+      settings.append(("other_config:%s" % key, value))
+    ports[_ovs_atoms(row["_uuid"])[0]] = {
+      "name": row["name"], "settings": settings,
+      "interfaces": sorted((interfaces[uuid]
+                            for uuid in _ovs_atoms(row["interfaces"])),
+                           key=lambda iface: iface["name"])}
+
+  bridges = []
+  for row in tables["Bridge"]:
+    if row["name"] not in kvm_net_utils.VALID_VSWITCHES:
+      continue
+    bridge_ports = sorted((ports[uuid] for uuid in _ovs_atoms(row["ports"])),
+                          key=lambda port: port["name"])
+    bridges.append({"name": row["name"], "ports": bridge_ports})
+  return sorted(bridges, key=lambda bridge: bridge["name"])
+
+def build_ovs_restore_cmd(bridges):
+  """
+  Returns the ovs-vsctl command which replaces the Nutanix vswitches with
+  bridges, as captured by capture_ovs, in a single transaction.
+  """
+  cmd = ["ovs-vsctl"]
+  for name in kvm_net_utils.VALID_VSWITCHES:
+    cmd += ["--", "--if-exists", "del-br", name]
+  for bridge in bridges:
+    cmd += ["--", "add-br", bridge["name"]]
+    for port in bridge["ports"]:
+      iface_names = [iface["name"] for iface in port["interfaces"]]
+      # The bridge internal port is created by add-br.
+      if port["name"] != bridge["name"]:
+        if len(iface_names) > 1:
+          cmd += ["--", "add-bond", bridge["name"], port["name"]] + iface_names
+        else:
+          cmd += ["--", "add-port", bridge["name"], port["name"]]
+      if port["settings"]:
+        cmd += ["--", "set", "Port", port["name"]] + [
+            "%s=%s" % (column, _ovs_string(value))
+            for column, value in port["settings"]]
+      for iface in port["interfaces"]:
+        if iface["settings"]:
+          cmd += ["--", "set", "Interface", iface["name"]] + [
+              "%s=%s" % (column, _ovs_string(value))
+              for column, value in iface["settings"]]
+  return cmd
+
+def capture_cvm_ifcfgs():
+  """
+  Captures all ifcfg files of the cvm with a single ssh call.
+  Returns a dict mapping interface name to content.
+  """
+  cmd = ("cd %s && sudo tar -cf - %s* | base64"
+         % (netUtil.IFCFG_DIR, netUtil.IFCFG_PREFIX))
+  out, _, _ = run_cmd_on_svm(cmd, dest_host=CVM_SSH_HOST, quiet=True)
+  ifcfgs = {}
+  archive = tarfile.open(fileobj=io.BytesIO(base64.b64decode(out)))
+  for member in archive.getmembers():
+    if member.isfile() and member.name.startswith(netUtil.IFCFG_PREFIX):
+      name = member.name[len(netUtil.IFCFG_PREFIX):]
+      ifcfgs[name] = archive.extractfile(member).read().decode("utf-8")
+  return ifcfgs
+
+def build_cvm_ifcfg_archive(ifcfgs):
+  """
+  Returns ifcfgs, a dict mapping interface name to content, as a tar archive.
+  """
+  data = io.BytesIO()
+  archive = tarfile.open(fileobj=data, mode="w")
+  for name, content in sorted(ifcfgs.items()):
+    content = content.encode("utf-8")
+    member = tarfile.TarInfo(netUtil.IFCFG_PREFIX + name)
+    member.size = len(content)
+    member.mode = 0o644
+    archive.addfile(member, io.BytesIO(content))
+  archive.close()
+  return data.getvalue()
+
+class Snapshot(object):
+  """
+  Network state of the host and the CVM, see capture().
+
+  Args:
+    cfg: Network configuration json about to be applied. It tells which
+        cvm ifcfg files may be created and which cvm interfaces are external.
+  """
+  def __init__(self, cfg):
+    self.cfg = cfg
+    self.ovs_bridges = None
+    self.host_ifcfgs = None
+    self.cvm_domain = None
+    self.cvm_ifcfgs = None
+    self._rollback_lock = threading.Lock()
+    # Outcome of the rollback, None until it ran.
+    self._rollback_result = None
+    self._main_thread = threading.current_thread()
+
+  def capture(self):
+    INFO("Capturing network state of host and CVM")
+    self.ovs_bridges = capture_ovs()
+    store = netUtil.IfcfgStore()
+    self.host_ifcfgs = dict((name, store.get_content(name))
+                            for name in store.names())
+    self.cvm_domain = libvirt_utils.capture_domain_network(
+        libvirt_utils.get_cvm_domain())
+    self.cvm_ifcfgs = capture_cvm_ifcfgs()
+    return self
+
+  def _external_cvm_interfaces(self):
+    return [iface["name"] for iface in self.cfg["cvm_interfaces"]
+            if iface["vswitch"] != "_internal_"]
+
+  def restore_ovs(self):
+    INFO("Restoring vswitches")
+    _, stderr, ret = run_cmd_new(build_ovs_restore_cmd(self.ovs_bridges),
+                                 fatal=False)
+    if ret:
+      ERROR("Failed to restore vswitches: %s" % stderr)
+    return not ret
+
+  def restore_host_ifcfgs(self):
+    INFO("Restoring host ifcfg files")
+    store = netUtil.IfcfgStore()
+    for name in store.names():
+      if name not in self.host_ifcfgs:
+        store.remove(name)
+    for name, content in self.host_ifcfgs.items():
+      store.set_content(name, content)
+    try:
+      changed = store.commit()
+    except (IOError, OSError) as e:
+      ERROR("Failed to restore host ifcfg files: %s" % e)
+      return False
+    if changed:
+      INFO("Restored ifcfg files of %s" % ", ".join(changed))
+      _, stderr, ret = run_cmd_new(["service", "network", "restart"],
+                                   fatal=False)
+      if ret:
+        ERROR("Failed to restart host network: %s" % stderr)
+        return False
+    return True
+
+  def restore_cvm_domain(self):
+    INFO("Restoring CVM domain")
+    return libvirt_utils.restore_domain_network(
+        libvirt_utils.get_cvm_domain(), self.cvm_domain)
+
+  def restore_cvm_ifcfgs(self):
+    """
+    Restores the cvm ifcfg files in one ssh call, removing the ones created
+    for the configuration, and restarts the external interfaces.
+    """
+    INFO("Restoring CVM ifcfg files")
+    created = [name for name in self._external_cvm_interfaces()
+               if name not in self.cvm_ifcfgs]
+    cmd = "cd %s && " % netUtil.IFCFG_DIR
+    if created:
+      cmd += "sudo rm -f %s && " % " ".join(netUtil.IFCFG_PREFIX + name
+                                            for name in created)
+    cmd += "base64 -d | sudo tar -xf - --no-same-owner"
+    archive = base64.b64encode(build_cvm_ifcfg_archive(self.cvm_ifcfgs))
+    _, stderr, ret = run_cmd_on_svm(cmd, dest_host=CVM_SSH_HOST, attempts=1,
+                                    fatal=False, input_data=archive)
+    if ret:
+      ERROR("Failed to restore CVM ifcfg files: %s" % stderr)
+      return False
+    names = [name for name in self._external_cvm_interfaces()
+             if name in self.cvm_ifcfgs]
+    if names:
+      return kvm_net_utils.restart_cvm_interfaces(names, fatal=False)
+    return True
+
+  def rollback(self):
+    """
+    Restores the captured state. Runs at most once, every subsystem is
+    restored even if an earlier one fails.
+
+    Returns True if everything was restored.
+    """
+    with self._rollback_lock:
+      if self._rollback_result is not None:
+        return self._rollback_result
+      INFO("Rolling back network configuration")
+      results = []
+      for restore in (self.restore_ovs, self.restore_host_ifcfgs,
+                      self.restore_cvm_domain, self.restore_cvm_ifcfgs):
+        try:
+          results.append(restore())
+        except BaseException as e:
+          # FATAL exits through SystemExit, keep restoring the rest.
+          ERROR("%s failed: %s" % (restore.__name__, e))
+          results.append(False)
+      self._rollback_result = all(results)
+      if self._rollback_result:
+        INFO("Network configuration rolled back")
+      else:
+        ERROR("Network configuration was only partially rolled back")
+      return self._rollback_result
+
+  def on_fatal(self):
+    """
+    Callback for log.set_log_fatal_callback. FATAL in a stage thread is left
+    to the thread which captured the snapshot, which rolls back once all
+    stages have stopped.
+    """
+    if threading.current_thread() is self._main_thread:
+      self.rollback()
+
+def capture(cfg):
+  """
+  Captures the network state of the host and the CVM before cfg is applied.
+  Returns a Snapshot.
+  """
+  return Snapshot(cfg).capture()
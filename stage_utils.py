@@ -0,0 +1,160 @@
+#
+# Copyright (c) 2019 Nutanix Inc. All rights reserved.
+#
+# This module contains a small dependency graph runner used to overlap
+# independent configuration stages.
+#
+import threading
+import traceback
+
+import trace_utils
+
+from log import ERROR, INFO
+
+class Stage(object):
+  def __init__(self, name, func, deps, verify=None):
+    self.name = name
+    self.func = func
+    self.deps = list(deps)
+    self.verify = verify
+
+class StageRunner(object):
+  """
+  Runs stages once all the stages they depend on have succeeded. Stages
+  which are ready at the same time run concurrently, so the wall time is
+  bounded by the critical path of the graph.
+
+  When a stage fails no new stage is started, the stages already running
+  are waited for, and the failure is raised again by run().
+
+  With a checkpoint_utils.Journal, every stage which succeeds is recorded in
+  it. A stage recorded by an earlier run is skipped if its verify callable
+  confirms that its effect is still in place and none of the stages it
+  depends on had to run again.
+  """
+  # Stage states.
+  PENDING = "pending"
+  RUNNING = "running"
+  DONE = "done"
+  FAILED = "failed"
+  SKIPPED = "skipped"
+
+  def __init__(self, max_workers=4, journal=None):
+    self.max_workers = max_workers
+    self.journal = journal
+    self.stages = []
+    self.states = {}
+    self.results = {}
+    # Stages skipped because the journal showed they were done.
+    self.reused = set()
+    self._stages_by_name = {}
+    self._failure = None
+    self._cv = threading.Condition()
+
+  def add_stage(self, name, func, deps=(), verify=None):
+    """
+    Adds a stage.
+
+    Args:
+      name: Unique name of the stage.
+      func: Callable run without arguments, its return value is kept in
+          results.
+      deps: Names of stages which must succeed before this one starts. They
+          must have been added already.
+      verify: Callable run without arguments which returns True if the
+          effect of a completed run of the stage is in place. Stages without
+          it are never skipped.
+    """
+    if name in self._stages_by_name:
+      raise ValueError("Stage %s already exists" % name)
+    for dep in deps:
+      if dep not in self._stages_by_name:
+        raise ValueError("Stage %s depends on unknown stage %s" % (name, dep))
+    stage = Stage(name, func, deps, verify)
+    self.stages.append(stage)
+    self._stages_by_name[name] = stage
+    self.states[name] = self.PENDING
+    return stage
+
+  def _ready_stages(self):
+    return [stage for stage in self.stages
+            if self.states[stage.name] == self.PENDING and
+            all(self.states[dep] == self.DONE for dep in stage.deps)]
+
+  def _can_skip(self, stage):
+    if (not self.journal or not stage.verify or
+        not self.journal.is_done(stage.name) or
+        any(dep not in self.reused for dep in stage.deps)):
+      return False
+    try:
+      with trace_utils.span("verify %s" % stage.name, trace_utils.PHASE):
+        return bool(stage.verify())
+    except BaseException as e:
+      INFO("Failed to verify stage %s, running it again: %s"
+           % (stage.name, e))
+      return False
+
+  def _run_stage(self, stage):
+    if self._can_skip(stage):
+      INFO("Stage %s was completed by an earlier run, skipping" % stage.name)
+      with self._cv:
+        self.reused.add(stage.name)
+        self.results[stage.name] = None
+        self.states[stage.name] = self.DONE
+        self._cv.notify_all()
+      return
+    try:
+      with trace_utils.span(stage.name, trace_utils.PHASE):
+        result = stage.func()
+      state = self.DONE
+      if self.journal:
+        self.journal.mark_done(stage.name)
+    except BaseException as e:
+      # FATAL exits through SystemExit, which must not escape the thread.
+      if not isinstance(e, SystemExit):
+        ERROR("Stage %s failed: %s %s" % (stage.name, e,
+                                          traceback.format_exc()))
+      result = None
+      state = self.FAILED
+      with self._cv:
+        if self._failure is None:
+          self._failure = e
+    with self._cv:
+      self.results[stage.name] = result
+      self.states[stage.name] = state
+      self._cv.notify_all()
+
+  def run(self):
+    """
+    Runs all stages.
+    Returns the results keyed by stage name, raises the first failure.
+    """
+    threads = []
+    with self._cv:
+      while True:
+        running = [name for name, state in self.states.items()
+                   if state == self.RUNNING]
+        if self._failure is None:
+          for stage in self._ready_stages()[:self.max_workers - len(running)]:
+            self.states[stage.name] = self.RUNNING
+            running.append(stage.name)
+            thread = threading.Thread(target=self._run_stage, args=(stage,),
+                                      name="stage-%s" % stage.name)
+            thread.daemon = True
+            threads.append(thread)
+            thread.start()
+        if not running:
+          break
+        self._cv.wait(1)
+
+    for thread in threads:
+      thread.join()
+
+    for stage in self.stages:
+      if self.states[stage.name] == self.PENDING:
+        self.states[stage.name] = self.SKIPPED
+        INFO("Skipped stage %s" % stage.name)
+
+    if self._failure is not None:
+      raise self._failure
+    return self.results
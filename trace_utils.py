@@ -0,0 +1,127 @@
+#
+# Copyright (c) 2019 Nutanix Inc. All rights reserved.
+#
+# This module records the timeline of a run as nested spans and exports it
+# in the Chrome trace event format, which can be opened with chrome://tracing
+# or Perfetto.
+#
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+# Span categories.
+PHASE = "phase"
+CMD = "cmd"
+SSH = "ssh"
+LIBVIRT = "libvirt"
+SLEEP = "sleep"
+
+_enabled = False
+_trace_path = None
+_events = []
+_events_lock = threading.Lock()
+# Holds the trace thread id of every thread. Thread idents are reused, these
+# ids are not, so that every thread gets its own row in the trace.
+_thread_local = threading.local()
+_next_tid = [1]
+_start_time = time.time()
+
+def enable(trace_path):
+  """
+  Starts recording spans. The trace is written to trace_path at exit.
+  """
+  global _enabled, _trace_path
+  if not _enabled:
+    atexit.register(write_trace)
+  _trace_path = trace_path
+  _enabled = True
+
+def is_enabled():
+  return _enabled
+
+def _timestamp_us(t):
+  return int((t - _start_time) * 1000000)
+
+def _add_event(event):
+  event["pid"] = os.getpid()
+  with _events_lock:
+    tid = getattr(_thread_local, "tid", None)
+    if tid is None:
+      tid = _thread_local.tid = _next_tid[0]
+      _next_tid[0] += 1
+      _events.append({"name": "thread_name", "ph": "M", "pid": event["pid"],
+                      "tid": tid,
+                      "args": {"name": threading.current_thread().name}})
+    event["tid"] = tid
+    _events.append(event)
+
+class span(object):
+  """
+  Context manager recording the enclosed block as a span. Spans of the same
+  thread nest by time.
+
+  Args:
+    name: Name of the span.
+    cat: Category, one of PHASE, CMD, SSH, LIBVIRT or SLEEP.
+    args: Dict of details shown with the span.
+  """
+  def __init__(self, name, cat=PHASE, args=None):
+    self.name = name
+    self.cat = cat
+    self.args = args
+    self.start = None
+
+  def __enter__(self):
+    if _enabled:
+      self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if self.start is None:
+      return False
+    end = time.time()
+    args = dict(self.args or {})
+    if exc_type is not None:
+      args["error"] = "%s: %s" % (exc_type.__name__, exc_value)
+    _add_event({"name": self.name, "cat": self.cat, "ph": "X",
+                "ts": _timestamp_us(self.start),
+                "dur": _timestamp_us(end) - _timestamp_us(self.start),
+                "args": args})
+    return False
+
+def traced(cat=PHASE, name=None):
+  """
+  Decorator recording every call of the decorated function as a span.
+  """
+  def decorator(func):
+    span_name = name or func.__name__
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with span(span_name, cat):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def sleep(secs, reason=None):
+  """
+  time.sleep recorded as a span.
+  """
+  with span(reason or "sleep", SLEEP, {"secs": secs}):
+    time.sleep(secs)
+
+def write_trace(trace_path=None):
+  """
+  Writes the recorded spans as a Chrome trace event json file.
+  """
+  trace_path = trace_path or _trace_path
+  if not trace_path:
+    return
+  with _events_lock:
+    events = list(_events)
+  temp_path = trace_path + ".tmp"
+  with open(temp_path, "w") as fp:
+    json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+  os.rename(temp_path, trace_path)